@@ -71,15 +71,21 @@ class Cache(object):
     def _loadConfig(self, config):
         cls = self.__class__
         logging.debug("Loading network parameters:")
-        self.crl = self.same_country = ()
+        self.same_country = ()
+        self.crl = x509.Crl()
         for k, v in config:
             if k == 'crl': # BBB
                 k = 'crl:json'
             if k.endswith(':json'):
                 k = k[:-5]
                 v = json.loads(v)
-                if k == 'crl':
-                    v = set(v)
+                if k == 'crl': # BBB
+                    v = x509.Crl(x509.serialRanges(sorted(v)))
+                elif k == 'crl_ranges':
+                    k = 'crl'
+                    v = x509.Crl(v)
+            elif k == 'registry_prefix':
+                v = utils.prefixFromBin(v)
             if hasattr(cls, k):
                 continue
             setattr(self, k, v)
@@ -89,9 +95,18 @@ class Cache(object):
         logging.info("Getting new network parameters from registry...")
         try:
             # TODO: When possible, the registry should be queried via the re6st.
-            x = json.loads(zlib.decompress(
-                self._registry.getNetworkConfig(self._prefix)))
+            x = None
+            # BBB: getNetworkConfigDelta appeared with protocol 7.
+            if getattr(self, 'version', None) and self.protocol >= 7:
+                # Only ask what changed since our version.
+                x = self._registry.getNetworkConfigDelta(str(self._prefix),
+                    self.version.encode('base64'))
+            if x is None:
+                x = self._registry.getNetworkConfig(str(self._prefix))
+            x = json.loads(zlib.decompress(x))
             base64 = x.pop('', ())
+            removed = x.pop('-', None)
+            crl = x.pop('+crl', None), x.pop('-crl', ())
             config = {}
             for k, v in x.iteritems():
                 k = str(k)
@@ -106,6 +121,17 @@ class Cache(object):
                     k += ':json'
                     v = json.dumps(v)
                 config[k] = v
+            if removed is not None:
+                # Complete the delta with what we already have.
+                for k, v in self._selectConfig(self._db.execute):
+                    name = k[:-5] if k.endswith(':json') else k
+                    if name == 'crl' and crl[0] is not None:
+                        v = set(json.loads(v)).difference(crl[1])
+                        v.update(crl[0])
+                        config['crl:json'] = json.dumps(sorted(v))
+                    elif not (name in x or name in removed
+                              or name.startswith('babel_hmac')):
+                        config[k] = v
         except socket.error, e:
             logging.warning(e)
             return
@@ -147,7 +173,7 @@ class Cache(object):
             logging.warning("There's a new version of re6stnet:"
                             " you should update.")
 
-    def getDh(self, path):
+    def getDh(self, path, registry=None):
         # We'd like to do a full check here but
         #   from OpenSSL import SSL
         #   SSL.Context(SSL.TLSv1_METHOD).load_tmp_dh(path)
@@ -156,7 +182,7 @@ class Cache(object):
             retry = 1
             while True:
                 try:
-                    dh = self._registry.getDh(self._prefix)
+                    dh = (registry or self._registry).getDh(str(self._prefix))
                     if dh:
                         break
                     e = None
@@ -194,7 +220,7 @@ class Cache(object):
 
     def connecting(self, prefix, connecting):
         self._db.execute("UPDATE volatile.stat SET try=? WHERE peer=?",
-                         (connecting, prefix))
+                         (connecting, str(prefix)))
 
     def resetConnecting(self):
         self._db.execute("UPDATE volatile.stat SET try=0")
@@ -202,7 +228,7 @@ class Cache(object):
     def getAddress(self, prefix):
         r = self._db.execute("SELECT address FROM peer, volatile.stat"
                              " WHERE prefix=? AND prefix=peer AND try=0",
-                             (prefix,)).fetchone()
+                             (str(prefix),)).fetchone()
         return r and r[0]
 
     @property
@@ -231,15 +257,19 @@ class Cache(object):
                     " WHERE prefix=peer AND prefix!=? AND try=?"
     def getPeerList(self, failed=0, __sql=_get_peer_sql % "prefix, address"
                                                         + " ORDER BY RANDOM()"):
-        return self._db.execute(__sql, (self._prefix, failed))
+        for prefix, address in self._db.execute(
+                __sql, (str(self._prefix), failed)):
+            yield utils.prefixFromBin(prefix), address
     def getPeerCount(self, failed=0, __sql=_get_peer_sql % "COUNT(*)"):
-        return self._db.execute(__sql, (self._prefix, failed)).next()[0]
+        return self._db.execute(__sql, (str(self._prefix), failed)
+            ).next()[0]
 
     def getBootstrapPeer(self):
         logging.info('Getting Boot peer...')
         try:
-            bootpeer = self._registry.getBootstrapPeer(self._prefix)
+            bootpeer = self._registry.getBootstrapPeer(str(self._prefix))
             prefix, address = self._decrypt(bootpeer).split()
+            prefix = utils.prefixFromBin(prefix)
         except (socket.error, subprocess.CalledProcessError, ValueError), e:
             logging.warning('Failed to bootstrap (%s)',
                             e if bootpeer else 'no peer returned')
@@ -251,6 +281,7 @@ class Cache(object):
 
     def addPeer(self, prefix, address, set_preferred=False):
         logging.debug('Adding peer %s: %s', prefix, address)
+        prefix = str(prefix)
         with self._db:
             q = self._db.execute
             try:
@@ -73,10 +73,10 @@ def main():
     network = x509.networkFromCa(ca)
     if config.is_needed:
         route, err = subprocess.Popen(('ip', '-6', '-o', 'route', 'get',
-                                       utils.ipFromBin(network)),
+                                       utils.ipFromPrefix(network)),
                                       stdout=subprocess.PIPE).communicate()
         sys.exit(err or route and
-            utils.binFromIp(route.split()[8]).startswith(network))
+            utils.prefixFromIp(route.split()[8]).startswith(network))
 
     create(ca_path, crypto.dump_certificate(crypto.FILETYPE_PEM, ca))
     if config.ca_only:
@@ -182,9 +182,9 @@ key %s
         print "Sample configuration file created."
 
     cn = x509.subnetFromCert(cert)
-    subnet = network + utils.binFromSubnet(cn)
+    subnet = network + utils.prefixFromSubnet(cn)
     print "Your subnet: %s/%u (CN=%s)" \
-        % (utils.ipFromBin(subnet), len(subnet), cn)
+        % (utils.ipFromPrefix(subnet), len(subnet), cn)
 
 if __name__ == "__main__":
     main()
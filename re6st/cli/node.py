@@ -5,8 +5,9 @@ from collections import deque
 from functools import partial
 if 're6st' not in sys.modules:
     sys.path[0] = os.path.dirname(os.path.dirname(sys.path[0]))
-from re6st import plib, tunnel, utils, version, x509
+from re6st import ctl, netlink, plib, tunnel, utils, version, x509
 from re6st.cache import Cache
+from re6st.registry import RegistryClient
 from re6st.utils import exit, ReexecException
 
 DEFAULT_DISABLED_PROTO = ['udp', 'udp6']
@@ -121,6 +122,11 @@ def getConfig():
     _('--neighbour', metavar='CN', action='append', default=[],
         help="List of peers that should be reachable directly, by creating"
              " tunnels if necesssary.")
+    _('--tunnel-strategy', default='random',
+        choices=sorted(tunnel.tunnel_strategy_dict),
+        help="How to choose peers to connect to and tunnels to remove."
+             " 'metric' uses route metrics and RTT measured by babeld."
+             " (default: random)")
 
     return parser.parse_args()
 
@@ -146,12 +152,21 @@ def main():
     exit.signal(0, signal.SIGINT, signal.SIGTERM)
     exit.signal(-1, signal.SIGHUP, signal.SIGUSR2)
 
+    def phase(name, last=[time.time()]):
+        t = time.time()
+        logging.info("Startup: %s in %.3fs", name, t - last[0])
+        last[0] = t
+
     cache = Cache(db_path, config.registry, cert)
     network = cert.network
+    phase("cache initialized")
 
-    if config.client_count is None:
+    # If not forced, the number of client tunnels follows network parameters.
+    auto_client_count = config.client_count is None
+    if auto_client_count:
         config.client_count = cache.client_count
-    if config.max_clients is None:
+    auto_max_clients = config.max_clients is None
+    if auto_max_clients:
         config.max_clients = cache.max_clients
 
     if config.table is not None:
@@ -263,22 +278,37 @@ def main():
             raise EnvironmentError("%r failed with error %u\n%s"
                                    % (' '.join(cmd), p.returncode, stderr))
         return stdout
-    def ip4(object, *args):
-        args = ['ip', '-4', object, 'add'] + list(args)
-        call(args)
-        args[3] = 'del'
-        cleanup.append(lambda: subprocess.call(args))
-    def ip(object, *args):
-        args = ['ip', '-6', object, 'add'] + list(args)
-        call(args)
-        args[3] = 'del'
-        cleanup.append(lambda: subprocess.call(args))
+    def ip(object, *args, **kw):
+        getattr(nl, object)('add', *args, **kw)
+        cleanup.append(lambda: getattr(nl, object)('del', *args, **kw))
 
     try:
+        if server_tunnels:
+            dh = config.dh
+            if dh:
+                wait_dh = lambda: None
+            else:
+                # Download DH parameters in the background, with a separate
+                # registry client, while the rest is set up.
+                dh = os.path.join(config.state, "dh.pem")
+                dh_error = []
+                def get_dh():
+                    try:
+                        cache.getDh(dh, RegistryClient(config.registry, cert))
+                    except BaseException:
+                        dh_error.append(sys.exc_info())
+                dh_thread = threading.Thread(target=get_dh)
+                dh_thread.daemon = True
+                dh_thread.start()
+                def wait_dh():
+                    dh_thread.join()
+                    if dh_error:
+                        e = dh_error[0]
+                        raise e[0], e[1], e[2]
         subnet = network + cert.prefix
-        my_ip = utils.ipFromBin(subnet, '1')
-        my_subnet = '%s/%u' % (utils.ipFromBin(subnet), len(subnet))
-        my_network = "%s/%u" % (utils.ipFromBin(network), len(network))
+        my_ip = utils.ipFromPrefix(subnet, 1)
+        my_subnet = '%s/%u' % (utils.ipFromPrefix(subnet), len(subnet))
+        my_network = "%s/%u" % (utils.ipFromPrefix(network), len(network))
         os.environ['re6stnet_ip'] = my_ip
         os.environ['re6stnet_iface'] = config.main_interface
         os.environ['re6stnet_subnet'] = my_subnet
@@ -290,17 +320,27 @@ def main():
         cleanup = [lambda: cache.cacheMinimize(config.client_count),
                    lambda: shutil.rmtree(config.run, True)]
         utils.makedirs(config.run, 0700)
+        nl = netlink.Netlink()
+        cleanup.append(nl.close)
+        loop = utils.EventLoop()
+        cleanup.append(loop.close)
+        supervisor = utils.Supervisor()
+        cleanup.append(supervisor.close)
         control_socket = os.path.join(config.run, 'babeld.sock')
         if config.client_count and not config.client:
             tunnel_manager = tunnel.TunnelManager(control_socket,
                 cache, cert, config.openvpn_args, timeout,
                 config.client_count, config.iface_list, address, ip_changed,
-                remote_gateway, config.disable_proto, config.neighbour)
+                remote_gateway, config.disable_proto, config.neighbour,
+                auto_client_count, config.tunnel_strategy, auto_max_clients)
             add_tunnels(tunnel_manager.new_iface_list)
+            tunnel_manager.createInterfaces()
+            cleanup.append(tunnel_manager.delInterfaces)
         else:
             tunnel_manager = tunnel.BaseTunnelManager(control_socket,
                 cache, cert, address)
         cleanup.append(tunnel_manager.sock.close)
+        phase("tunnel manager initialized")
 
         try:
             exit.acquire()
@@ -310,7 +350,8 @@ def main():
                 serial = cert.subject_serial
                 if cache.ipv4_sublen <= 16 and serial < 1 << cache.ipv4_sublen:
                     dot4 = lambda x: socket.inet_ntoa(struct.pack('!I', x))
-                    ip4('route', 'unreachable', ipv4, 'proto', 'static')
+                    ip('route', ipv4, type=netlink.RTN_UNREACHABLE,
+                       protocol=netlink.RTPROT_STATIC)
                     ipv4, n = ipv4.split('/')
                     ipv4, = struct.unpack('!I', socket.inet_aton(ipv4))
                     n = int(n) + cache.ipv4_sublen
@@ -319,10 +360,11 @@ def main():
                     config.openvpn_args += '--ifconfig', \
                         ipv4, dot4((1<<32) - (1<<32-n))
                     if not isinstance(tunnel_manager, tunnel.TunnelManager):
-                        ip4('addr', ipv4, 'dev', config.main_interface)
+                        ip('addr', ipv4, config.main_interface)
                         if config.main_interface == "lo":
-                            ip4('route', 'unreachable', "%s/%s" % (dot4(x), n),
-                                'proto', 'static')
+                            ip('route', "%s/%s" % (dot4(x), n),
+                               type=netlink.RTN_UNREACHABLE,
+                               protocol=netlink.RTPROT_STATIC)
                     ipv4 = ipv4, n
                 else:
                     logging.warning(
@@ -334,10 +376,13 @@ def main():
                     " does not support RTA_PREFSRC for ipv6. Note however that"
                     " this workaround does not work with extra interfaces that"
                     " already have a public IP")
-                ip('addrlabel', 'prefix', my_network, 'label', '99')
+                x = ['ip', '-6', 'addrlabel', 'add',
+                     'prefix', my_network, 'label', '99']
+                call(x)
+                x[3] = 'del'
+                cleanup.append(lambda: subprocess.call(x))
                 # No need to tell babeld not to set a preferred source IP in
                 # installed routes. The kernel will silently discard the option.
-            R = {}
             if config.client:
                 address_list = [x for x in utils.parse_address(config.client)
                                   if x[2] not in config.disable_proto]
@@ -347,87 +392,108 @@ def main():
                 cleanup.append(plib.client('re6stnet',
                     address_list, cache.encrypt, '--ping-restart',
                     str(timeout), *config.openvpn_args).stop)
-            elif server_tunnels:
-                dh = config.dh
-                if not dh:
-                    dh = os.path.join(config.state, "dh.pem")
-                    cache.getDh(dh)
-                for iface, (port, proto) in server_tunnels.iteritems():
-                    r, x = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
-                    utils.setCloexec(r)
-                    cleanup.append(plib.server(iface, config.max_clients,
-                        dh, x.fileno(), port, proto, cache.encrypt,
-                        '--ping-exit', str(timeout), *config.openvpn_args).stop)
-                    R[r] = partial(tunnel_manager.handleServerEvent, r)
-                    x.close()
 
-            ip('addr', my_ip + '/%s' % len(subnet),
-               'dev', config.main_interface)
-            if_rt = ['ip', '-6', 'route', 'del',
-                     'fe80::/64', 'dev', config.main_interface]
+            ip('addr', my_ip + '/%s' % len(subnet), config.main_interface)
             if config.main_interface == 'lo':
                 # WKRD: Removed this useless route now, since the kernel does
                 #       not even remove it on exit.
-                subprocess.call(if_rt)
-            if_rt[4] = my_subnet
-            cleanup.append(lambda: subprocess.call(if_rt))
+                nl.route('del', 'fe80::/64', dev=config.main_interface,
+                         ignore=(errno.ESRCH,))
+            cleanup.append(lambda: nl.route('del', my_subnet,
+                                            dev=config.main_interface))
             if config.default:
-                def check_no_default_route():
-                    for route in call(('ip', '-6', 'route', 'show',
-                                        'default')).splitlines():
-                        if not (' proto babel ' in route
-                             or ' proto 42 ' in route):
-                            sys.exit("Detected default route (%s)"
+                def check_no_default_route(nl):
+                    for route in nl.iterRoutes():
+                        # proto 42 is babel
+                        if not (route.dst_len or route.cloned
+                                or route.table != netlink.RT_TABLE_MAIN
+                                or route.protocol == 42):
+                            sys.exit("Detected default route (proto %u)"
                                 " whereas you specified --default."
-                                " Fix your configuration." % route)
-                check_no_default_route()
+                                " Fix your configuration." % route.protocol)
+                check_no_default_route(nl)
                 def check_no_default_route_thread():
+                    # netlink sockets are not thread-safe
+                    nl = netlink.Netlink()
                     try:
                         while True:
                             time.sleep(60)
-                            try:
-                                check_no_default_route()
-                            except OSError, e:
-                                if e.errno != errno.ENOMEM:
-                                    raise
+                            check_no_default_route(nl)
                     except:
                         utils.log_exception()
                     finally:
+                        nl.close()
                         exit.kill_main(1)
                 t = threading.Thread(target=check_no_default_route_thread)
                 t.daemon = True
                 t.start()
             else:
-                x = ['ip', '-6', 'route', 'add',
-                     'unreachable', '::/128', 'from', '::/128']
-                if subprocess.call(x):
+                x = '::/128', None, None, '::/128', netlink.RTN_UNREACHABLE
+                try:
+                    nl.route('add', *x)
+                except netlink.NetlinkError:
                     sys.exit('error: Source address based routing is not'
                              ' enabled in your kernel (CONFIG_IPV6_SUBTREES).'
                              ' Try with the --default option.')
-                x[3] = 'del'
-                subprocess.check_call(x)
-            ip('route', 'unreachable', my_network)
+                nl.route('del', *x)
+            ip('route', my_network, type=netlink.RTN_UNREACHABLE)
+            phase("network configured")
 
             config.babel_args += config.iface_list
-            cleanup.append(plib.router((my_ip, len(subnet)), ipv4,
-                None if config.gateway else
-                '' if config.default else
-                my_network, cache.hello,
-                os.path.join(config.log, 'babeld.log'),
-                os.path.join(config.state, 'babeld.state'),
-                os.path.join(config.run, 'babeld.pid'),
-                control_socket, cache.babel_default,
-                tuple(getattr(cache, k, None) for k in
-                      ('babel_hmac_sign', 'babel_hmac_accept')),
-                *config.babel_args).stop)
+            def babeld():
+                # Network parameters are read again at each restart.
+                return plib.router((my_ip, len(subnet)), ipv4,
+                    None if config.gateway else
+                    '' if config.default else
+                    my_network, cache.hello,
+                    os.path.join(config.log, 'babeld.log'),
+                    os.path.join(config.state, 'babeld.state'),
+                    os.path.join(config.run, 'babeld.pid'),
+                    control_socket, cache.babel_default,
+                    tuple(getattr(cache, k, None) for k in
+                          ('babel_hmac_sign', 'babel_hmac_accept')),
+                    *config.babel_args)
+            tunnel_manager.babeld = utils.ManagedProcess(supervisor,
+                'babeld', babeld, tunnel_manager.babeldRestarted)
+            cleanup.append(tunnel_manager.babeld.stop)
+            phase("babeld started")
+            # Keep babeld cleanup at the end, so that babeld is stopped first,
+            # which gives a chance to send wildcard retractions.
+            if server_tunnels:
+                wait_dh()
+                phase("DH parameters available")
+                server_sock = {}
+                def server(iface, port, proto):
+                    r, x = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    utils.setCloexec(r)
+                    try:
+                        return plib.server(iface, cache.max_clients
+                            if auto_max_clients else config.max_clients,
+                            dh, x.fileno(), port, proto, cache.encrypt,
+                            '--ping-exit', str(timeout), *config.openvpn_args)
+                    finally:
+                        x.close()
+                        old = server_sock.get(iface)
+                        if old:
+                            loop.unregister(old)
+                            old.close()
+                        server_sock[iface] = r
+                        loop.register(r,
+                            partial(tunnel_manager.handleServerEvent, r))
+                tunnel_manager.servers = []
+                for iface, (port, proto) in server_tunnels.iteritems():
+                    p = utils.ManagedProcess(supervisor, iface,
+                        partial(server, iface, port, proto),
+                        partial(tunnel_manager.serverRestarted, iface))
+                    tunnel_manager.servers.append(p)
+                    cleanup.insert(-1, p.stop)
+                phase("OpenVPN servers started")
             if config.up:
                 exit.release()
                 r = os.system(config.up)
                 if r:
                     sys.exit(r)
                 exit.acquire()
-            # Keep babeld cleanup at the end, so that babeld is stopped first,
-            # which gives a chance to send wildcard retractions.
             for cmd in config.daemon or ():
                 cleanup.insert(-1, utils.Popen(cmd, shell=True).stop)
             cleanup.insert(-1, tunnel_manager.close)
@@ -445,14 +511,21 @@ def main():
 
             # main loop
             exit.release()
-            select_list = [forwarder.select] if forwarder else []
+            if forwarder:
+                forwarder.register(loop)
             if config.console:
-                select_list.append(console.select)
-            select_list += tunnel_manager.select, utils.select
+                console.register(loop)
+            tunnel_manager.register(loop)
+            if isinstance(tunnel_manager, tunnel.TunnelManager):
+                supervisor.callbacks.append(tunnel_manager.childExited)
+            supervisor.register(loop)
             while True:
-                args = R.copy(), {}, []
-                for s in select_list:
-                    s(*args)
+                try:
+                    loop.run_once()
+                except ctl.ConnectionClosed, e:
+                    # babeld died and the supervisor restarts it.
+                    logging.warning("%s", e)
+                    tunnel_manager.ctl.reset()
         finally:
             # XXX: We have a possible race condition if a signal is handled at
             #      the beginning of this clause, just before the following line.
@@ -5,17 +5,25 @@ from . import utils
 uint16 = struct.Struct("!H")
 header = struct.Struct("!HI")
 
+# Head of the raw prefix of IPv4 routes, which babeld gives
+# as IPv4-mapped IPv6 addresses (::ffff:0:0/96).
+IPV4_MAPPED = socket.inet_pton(socket.AF_INET6, '::ffff:0:0')[:12]
+
 class Struct(object):
 
     def __init__(self, format, *args):
         if args:
             t = namedtuple(*args)
         if isinstance(format, str):
-            s = struct.Struct("!" + format)
+            self.struct = s = struct.Struct("!" + format)
             def encode(buffer, value):
                 buffer += s.pack(*value)
-            def decode(buffer, offset=0):
-                return offset + s.size, t(*s.unpack_from(buffer, offset))
+            if args:
+                self.make = make = t._make
+                unpack_from = s.unpack_from
+                size = s.size
+                def decode(buffer, offset=0):
+                    return offset + size, make(unpack_from(buffer, offset))
         else:
             def encode(buffer, value):
                 for f, value in zip(format, value):
@@ -27,7 +35,8 @@ class Struct(object):
                     r.append(x)
                 return offset, t(*r)
         self.encode = encode
-        self.decode = decode
+        if args:
+            self.decode = decode
 
 class Array(object):
 
@@ -41,14 +50,59 @@ class Array(object):
             encode(buffer, value)
 
     def decode(self, buffer, offset=0):
-        r = []
         o = offset + 2
-        decode = self._item.decode
-        for i in xrange(*uint16.unpack_from(buffer, offset)):
+        n, = uint16.unpack_from(buffer, offset)
+        item = self._item
+        if hasattr(item, 'make'):
+            # Fixed-size items: copy them at once, and only decode
+            # the ones that are accessed.
+            offset = o + n * item.struct.size
+            return offset, Records(item, buffer[o:offset])
+        r = []
+        decode = item.decode
+        for i in xrange(n):
             o, x = decode(buffer, o)
             r.append(x)
         return o, r
 
+class Records(object):
+    """Lazy sequence of records of an Array of fixed-size Struct"""
+
+    def __init__(self, item, data):
+        self._item = item
+        self._data = data
+
+    def __len__(self):
+        return len(self._data) // self._item.struct.size
+
+    def __getitem__(self, i):
+        s = self._item.struct
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._item.make(s.unpack_from(self._data, i * s.size))
+
+    def __iter__(self):
+        return self.iterexcept('')
+
+    def iterexcept(self, head):
+        """Iterate over records whose raw data do not start with 'head'
+
+        This is a cheap way to skip records without decoding them.
+        """
+        s = self._item.struct
+        make = self._item.make
+        unpack_from = s.unpack_from
+        data = self._data
+        n = len(head)
+        for offset in xrange(0, len(data), s.size):
+            if not (n and data[offset:offset+n] == head):
+                yield make(unpack_from(data, offset))
+
+    def __repr__(self):
+        return repr(list(self))
+
 class String(object):
 
     @staticmethod
@@ -185,9 +239,13 @@ class ConnectionClosed(BabelException):
 class Babel(object):
 
     _decode = None
+    _loop = None
 
     def __init__(self, socket_path, handler, network):
         self.socket_path = socket_path
+        # Live index of installed routes to nodes of the network:
+        # {dst_prefix: route}
+        self.routes = {}
         self.handler = handler
         self.network = network
         self.locked = set()
@@ -195,15 +253,17 @@ class Babel(object):
 
     def reset(self):
         try:
-            del self.socket, self.request_dump
-        except AttributeError:
+            self.close()
+        except AttributeError: # called by __init__
             pass
+        self.__dict__.pop('socket', None)
+        self.__dict__.pop('request_dump', None)
         self.write_buffer = Buffer()
         self.read_buffer = Buffer()
         self.read_buffer.want(header.size)
         s = socket.socket(socket.AF_UNIX,
             socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
-        def select(*args):
+        def connect():
             try:
                 s.connect(self.socket_path)
             except socket.error, e:
@@ -211,14 +271,30 @@ class Babel(object):
                 return e
             s.send("\1")
             s.setblocking(0)
-            del self.select
+            del self.connect
             self.socket = s
-            return self.select(*args)
-        self.select = select
-        self.close = s.close
+            self._register()
+        self.connect = connect
+        def close():
+            if self._loop and self.__dict__.get('socket') is s:
+                self._loop.unregister(s)
+            s.close()
+        self.close = close
+
+    def connect(self):
+        pass # already connected
+
+    def register(self, loop):
+        self._loop = loop
+        self.connect()
+
+    def _register(self):
+        if self._loop:
+            self._loop.register(self.socket, self._read,
+                                self.write_buffer and self._write)
 
     def request_dump(self):
-        if self.select({}, {}, ()):
+        if self.connect():
             self.handle_dump((), (), (), ())
         else:
             # interfaces + neighbours + installed routes
@@ -227,12 +303,8 @@ class Babel(object):
 
     def send(self, packet):
         packet.write(self.write_buffer)
-
-    def select(self, r, w, t):
-        s = self.socket
-        r[s] = self._read
-        if self.write_buffer:
-            w[s] = self._write
+        if hasattr(self, 'socket'):
+            self._register()
 
     def _read(self):
         d = self.socket.recv(65536)
@@ -259,23 +331,33 @@ class Babel(object):
 
     def _write(self):
         self.write_buffer.send(self.socket)
+        if not self.write_buffer:
+            self._register()
 
     def handle_dump(self, interfaces, neighbours, xroutes, routes):
         # neighbours = {neigh_prefix: (neighbour, {dst_prefix: route})}
         n = {(n.address, n.ifindex): (n, {}) for n in neighbours}
         unidentified = set(n)
         self.neighbours = neighbours = {}
+        index = {}
         a = len(self.network)
-        for route in routes:
+        shift = 128 - a
+        network = self.network.value
+        if routes: # empty tuple if babeld could not be reached
+            # Skip IPv4 routes without decoding them.
+            installed = routes.iterexcept(IPV4_MAPPED)
+        else:
+            installed = ()
+        for route in installed:
             assert route.flags & 1, route # installed
-            if route.prefix.startswith('\0\0\0\0\0\0\0\0\0\0\xff\xff'):
-                continue
             assert route.neigh_address == route.nexthop, route
             address = route.neigh_address, route.ifindex
             neigh_routes = n[address]
-            ip = utils.binFromRawIp(route.prefix)
-            if ip[:a] == self.network:
-                prefix = ip[a:route.plen]
+            ip = utils.intFromRawIp(route.prefix)
+            if ip >> shift == network:
+                prefix = utils.prefixFromIntIp(ip, a, route.plen)
+                if prefix:
+                    index[prefix] = route
                 if prefix and not route.refmetric:
                     neighbours[prefix] = neigh_routes
                     # XXX: Temporary logging to understand when a KeyError
@@ -308,8 +390,39 @@ class Babel(object):
                 logging.trace("Routes via unidentified neighbours. %r",
                               neighbours)
         self.interfaces = {i.index: name for i, name in interfaces}
+        self._updateRoutes(index)
         self.handler.babel_dump()
 
+    def _updateRoutes(self, index):
+        try:
+            h = self.handler.babel_routes
+        except AttributeError:
+            # Nobody is interested in changes.
+            self.routes = index
+            return
+        # babeld has no way to notify changes so we compare with the
+        # previous dump. A route is changed if it goes via another node.
+        routes = self.routes
+        added = []
+        changed = []
+        for prefix, route in index.iteritems():
+            try:
+                old = routes[prefix]
+            except KeyError:
+                added.append(prefix)
+            else:
+                if (old.nexthop != route.nexthop or
+                    old.ifindex != route.ifindex):
+                    changed.append(prefix)
+            routes[prefix] = route
+        removed = [prefix for prefix in routes if prefix not in index]
+        for prefix in removed:
+            del routes[prefix]
+        if added or removed or changed:
+            logging.trace("routes: %u added, %u removed, %u changed",
+                          len(added), len(removed), len(changed))
+            h(added, removed, changed)
+
     def handle_set_cost_multiplier(self, flags):
         pass
 
@@ -321,15 +434,14 @@ class iterRoutes(object):
     def __new__(cls, control_socket, network):
         self = object.__new__(cls)
         c = Babel(control_socket, self, network)
+        loop = utils.EventLoop()
+        c.register(loop)
         c.request_dump()
         while self._waiting:
-            args = {}, {}, ()
-            c.select(*args)
-            utils.select(*args)
-        return (prefix
-            for neigh_routes in c.neighbours.itervalues()
-            for prefix in neigh_routes[1]
-            if prefix)
+            loop.run_once()
+        c.close()
+        loop.close()
+        return iter(c.routes)
 
     def babel_dump(self):
         self._waiting = False
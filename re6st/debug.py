@@ -61,9 +61,7 @@ class Console(object):
             t = threading.Thread(target=pdb, args=(Socket(s.accept()[0]),))
             t.daemon = True
             t.start()
-        def select(r, w, t):
-            r[s] = accept
-        self.select = select
+        self.register = lambda loop: loop.register(s, accept)
 
     def close(self):
         self._removeSocket()
@@ -0,0 +1,289 @@
+"""Minimal rtnetlink client
+
+Only what re6stnet needs, so that large routing tables are not parsed
+from /proc, and routes & addresses are changed without forking 'ip'.
+"""
+import errno, os, socket, struct
+from . import utils # for socket.SOCK_CLOEXEC
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_DUMP = 0x300
+
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+
+RTM_F_CLONED = 0x200
+
+RT_TABLE_MAIN = 254
+
+RTPROT_BOOT = 3
+RTPROT_STATIC = 4
+
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_NOWHERE = 255
+
+RTN_UNICAST = 1
+RTN_LOCAL = 2
+RTN_UNREACHABLE = 7
+
+RTA_DST = 1
+RTA_SRC = 2
+RTA_OIF = 4
+RTA_GATEWAY = 5
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+nlmsghdr = struct.Struct("=IHHII")
+nlmsgerr = struct.Struct("=i")
+rtmsg = struct.Struct("=BBBBBBBBI")
+ifinfomsg = struct.Struct("=BxHiII")
+ifaddrmsg = struct.Struct("=BBBBI")
+rtattr = struct.Struct("=HH")
+
+
+def align(n):
+    return n + 3 & ~3
+
+def attributes(data, offset, end):
+    """Parse attributes of a message: {type: raw value}"""
+    attrs = {}
+    while offset + rtattr.size <= end:
+        size, type = rtattr.unpack_from(data, offset)
+        if size < rtattr.size:
+            break
+        attrs[type & 0x3fff] = data[offset+rtattr.size:offset+size]
+        offset += align(size)
+    return attrs
+
+def attribute(type, value):
+    size = rtattr.size + len(value)
+    return rtattr.pack(size, type) + value + '\0' * (align(size) - size)
+
+def parsePrefix(prefix):
+    """'<ip>[/<len>]' -> (family, raw ip, len)"""
+    ip, _, n = prefix.partition('/')
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    ip = socket.inet_pton(family, ip)
+    return family, ip, int(n) if n else 8 * len(ip)
+
+def ifindex(iface):
+    try:
+        f = open('/sys/class/net/%s/ifindex' % iface)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        # Like the kernel, for a request about an interface that is gone.
+        raise NetlinkError(errno.ENODEV, '%s: %s'
+                           % (iface, os.strerror(errno.ENODEV)))
+    with f:
+        return int(f.read())
+
+def flushRouteCache():
+    """Same as 'ip -6 route flush cached'"""
+    with open('/proc/sys/net/ipv6/route/flush', 'w') as f:
+        f.write('1')
+
+
+class NetlinkError(EnvironmentError): pass
+
+
+class Route(object):
+
+    __slots__ = ('family', 'dst_len', 'table', 'protocol', 'type', 'flags',
+                 'attrs')
+
+    def __init__(self, data, offset, end):
+        (self.family, self.dst_len, _, _, self.table, self.protocol, _,
+         self.type, self.flags) = rtmsg.unpack_from(data, offset)
+        self.attrs = attributes(data, offset + rtmsg.size, end)
+
+    @property
+    def cloned(self):
+        return bool(self.flags & RTM_F_CLONED)
+
+    @property
+    def dst(self):
+        return self.attrs.get(RTA_DST)
+
+    @property
+    def gateway(self):
+        return self.attrs.get(RTA_GATEWAY)
+
+
+class Netlink(object):
+    """rtnetlink socket
+
+    Changes are sent at once, and their acknowledgements are waited,
+    at the end of the outermost 'with' block. Outside such a block,
+    each change is committed immediately.
+    """
+
+    _batch = 0
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_NETLINK,
+            socket.SOCK_RAW | socket.SOCK_CLOEXEC, NETLINK_ROUTE)
+        self._sock.bind((0, 0))
+        self._seq = 0
+        self._queue = []
+
+    def close(self):
+        self._sock.close()
+
+    def __enter__(self):
+        self._batch += 1
+        return self
+
+    def __exit__(self, t, v, tb):
+        self._batch -= 1
+        if not self._batch:
+            if t is None:
+                self.commit()
+            else:
+                del self._queue[:]
+
+    def _pack(self, type, flags, payload):
+        self._seq = seq = self._seq + 1 & 0xffffffff
+        return seq, nlmsghdr.pack(nlmsghdr.size + len(payload),
+                                  type, flags, seq, 0) + payload
+
+    def _recv(self, seq_set):
+        """Iterate over (seq, type, data, offset, end) of replies
+
+        A NLMSG_DONE or an acknowledgement removes the sequence number
+        of its request from seq_set. Errors are given as NetlinkError
+        instances in place of the message type.
+        """
+        while seq_set:
+            data = self._sock.recv(1 << 16)
+            offset = 0
+            n = len(data)
+            while offset + nlmsghdr.size <= n:
+                size, type, flags, seq, _ = nlmsghdr.unpack_from(data, offset)
+                if size < nlmsghdr.size:
+                    break
+                end = offset + size
+                if seq in seq_set:
+                    offset += nlmsghdr.size
+                    if type == NLMSG_DONE:
+                        seq_set.remove(seq)
+                    elif type == NLMSG_ERROR:
+                        seq_set.remove(seq)
+                        e, = nlmsgerr.unpack_from(data, offset)
+                        if e:
+                            yield (seq, NetlinkError(-e, os.strerror(-e)),
+                                   data, offset, end)
+                    else:
+                        yield seq, type, data, offset, end
+                        if not flags & NLM_F_MULTI:
+                            seq_set.remove(seq)
+                offset = align(end)
+
+    def dump(self, type, payload):
+        seq, msg = self._pack(type, NLM_F_REQUEST | NLM_F_DUMP, payload)
+        self._sock.send(msg)
+        for seq, type, data, offset, end in self._recv({seq}):
+            if isinstance(type, NetlinkError):
+                raise type
+            yield type, data, offset, end
+
+    def iterRoutes(self, family=socket.AF_INET6, cloned=False):
+        """Dump routes of all tables
+
+        With cloned=True, ask for cached routes, which are flagged with
+        RTM_F_CLONED. Older kernels ignore the request and dump everything.
+        """
+        for type, data, offset, end in self.dump(RTM_GETROUTE, rtmsg.pack(
+                family, 0, 0, 0, 0, 0, 0, 0, RTM_F_CLONED if cloned else 0)):
+            yield Route(data, offset, end)
+
+    def request(self, type, flags, payload, ignore=()):
+        """Queue a change
+
+        'ignore' lists errno values that must not raise.
+        """
+        self._queue.append((ignore,) + self._pack(type,
+            NLM_F_REQUEST | NLM_F_ACK | flags, payload))
+        if not self._batch:
+            self.commit()
+
+    def commit(self):
+        """Send queued changes at once and raise the first error, if any"""
+        queue = self._queue
+        if queue:
+            self._queue = []
+            ignore = {seq: ignore for ignore, seq, msg in queue}
+            self._sock.send(''.join(msg for ignore, seq, msg in queue))
+            error = None
+            for seq, e, data, offset, end in self._recv(set(ignore)):
+                if (error is None and isinstance(e, NetlinkError)
+                    and e.errno not in ignore[seq]):
+                    error = e
+            if error:
+                raise error
+
+    def route(self, cmd, dst, gateway=None, dev=None, src=None,
+              type=RTN_UNICAST, protocol=RTPROT_BOOT, **kw):
+        """Add or delete a route, like 'ip route add|del'"""
+        family, dst, dst_len = parsePrefix(dst)
+        attrs = attribute(RTA_DST, dst)
+        if src:
+            _, src, src_len = parsePrefix(src)
+            attrs += attribute(RTA_SRC, src)
+        else:
+            src_len = 0
+        if gateway:
+            attrs += attribute(RTA_GATEWAY, parsePrefix(gateway)[1])
+        if dev:
+            attrs += attribute(RTA_OIF, struct.pack("=i", ifindex(dev)))
+        if cmd == 'add':
+            msg_type = RTM_NEWROUTE
+            flags = NLM_F_CREATE | NLM_F_EXCL
+            scope = RT_SCOPE_UNIVERSE
+        else:
+            assert cmd == 'del', cmd
+            msg_type = RTM_DELROUTE
+            flags = protocol = 0
+            scope = RT_SCOPE_NOWHERE
+        self.request(msg_type, flags, rtmsg.pack(family, dst_len, src_len, 0,
+            RT_TABLE_MAIN, protocol, scope, type, 0) + attrs, **kw)
+
+    def delLink(self, dev, ignore=()):
+        """Same as 'ip link del'"""
+        try:
+            index = ifindex(dev)
+        except NetlinkError, e:
+            # Not queued so 'ignore' must be checked now.
+            if e.errno in ignore:
+                return
+            raise
+        self.request(RTM_DELLINK, 0, ifinfomsg.pack(
+            socket.AF_UNSPEC, 0, index, 0, 0), ignore)
+
+    def addr(self, cmd, address, dev, **kw):
+        """Add or delete an address, like 'ip addr add|del'"""
+        family, address, prefixlen = parsePrefix(address)
+        attrs = attribute(IFA_LOCAL, address) + attribute(IFA_ADDRESS, address)
+        if cmd == 'add':
+            msg_type = RTM_NEWADDR
+            flags = NLM_F_CREATE | NLM_F_EXCL
+        else:
+            assert cmd == 'del', cmd
+            msg_type = RTM_DELADDR
+            flags = 0
+        self.request(msg_type, flags, ifaddrmsg.pack(family, prefixlen, 0,
+            RT_SCOPE_UNIVERSE, ifindex(dev)) + attrs, **kw)
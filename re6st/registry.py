@@ -19,19 +19,23 @@ Authenticated communication:
   - the one of the last handshake (hello)
 """
 import base64, hmac, hashlib, httplib, inspect, json, logging
-import mailbox, os, platform, random, select, smtplib, socket, sqlite3
+import mailbox, os, platform, random, smtplib, socket, sqlite3
 import string, struct, sys, threading, time, weakref, zlib
 from collections import defaultdict, deque
 from datetime import datetime
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from email.mime.text import MIMEText
 from operator import itemgetter
+from Queue import Empty, Queue
 from OpenSSL import crypto
 from urllib import splittype, splithost, unquote, urlencode
 from . import ctl, tunnel, utils, version, x509
 
 HMAC_HEADER = "Re6stHMAC"
 RENEW_PERIOD = 30 * 86400
+# Number of previous network configurations for which
+# getNetworkConfigDelta can send only what changed.
+CONFIG_HISTORY = 16
 GRACE_PERIOD = 100 * 86400
 BABEL_HMAC = 'babel_hmac0', 'babel_hmac1', 'babel_hmac2'
 
@@ -54,12 +58,31 @@ class RegistryServer(object):
 
     peers = 0, ()
     cert_duration = 365 * 86400
+    # Maximum number of queries to nodes that are waiting for a reply.
+    query_window = 64
+    _network_config_cache = None
 
     def __init__(self, config):
         self.config = config
+        # Locks are always taken in the following order, to avoid deadlocks:
+        # - lock: database, and state derived from it
+        # - sessions_lock: HMAC secrets of clients
+        # - sock_lock: waiters for replies from nodes
+        # Slow operations (queries to nodes, public-key encryption)
+        # should be done without holding 'lock'.
         self.lock = threading.Lock()
+        self.sessions_lock = threading.Lock()
         self.sessions = {}
+        # [(version, network config without 'version')]
+        self._config_history = deque(maxlen=CONFIG_HISTORY)
+        self.sock_lock = threading.Lock()
         self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.sock.bind(('::1', 0))
+        # {(prefix, code): [queue]}, with prefix=None for any node
+        self._waiters = defaultdict(list)
+        t = threading.Thread(target=self._recvLoop)
+        t.daemon = True
+        t.start()
 
         # Database initializing
         db_dir = os.path.dirname(self.config.db)
@@ -85,19 +108,20 @@ class RegistryServer(object):
         utils.sqliteCreateTable(self.db, "crl",
                 "serial INTEGER PRIMARY KEY NOT NULL",
                 # Expiration date of revoked certificate.
-                # TODO: purge rows with dates in the past.
                 "date INTEGER NOT NULL")
 
         self.cert = x509.Cert(self.config.ca, self.config.key)
         # Get vpn network prefix
         self.network = self.cert.network
-        logging.info("Network: %s/%u", utils.ipFromBin(self.network),
+        logging.info("Network: %s/%u", utils.ipFromPrefix(self.network),
                                        len(self.network))
         self.email = self.cert.ca.get_subject().emailAddress
 
         self.peers_lock = threading.Lock()
         self.ctl = ctl.Babel(os.path.join(config.run, 'babeld.sock'),
             weakref.proxy(self), self.network)
+        self.ctl_loop = utils.EventLoop()
+        self.ctl.register(self.ctl_loop)
 
         self.onTimeout()
         if self.prefix:
@@ -116,13 +140,16 @@ class RegistryServer(object):
                         name_value)
 
     def updateNetworkConfig(self, _it0=itemgetter(0)):
+        crl = map(_it0, self.db.execute(
+            "SELECT serial FROM crl ORDER BY serial"))
         kw = {
             'babel_default': 'max-rtt-penalty 5000 rtt-max 500 rtt-decay 125',
-            'crl': map(_it0, self.db.execute(
-                "SELECT serial FROM crl ORDER BY serial")),
+            'crl_ranges': x509.serialRanges(crl),
             'protocol': version.protocol,
             'registry_prefix': self.prefix,
         }
+        if self.config.min_protocol < 7: # BBB
+            kw['crl'] = crl
         if self.config.ipv4:
             kw['ipv4'], kw['ipv4_sublen'] = self.config.ipv4
         if self.config.same_country:
@@ -139,10 +166,17 @@ class RegistryServer(object):
             self.setConfig('version', buffer(self.version))
             self.setConfig('last_config', config)
             self.sendto(self.prefix, 0)
+        self._addConfigHistory(kw.copy())
         # The following entry lists values that are base64-encoded.
         kw[''] = 'version',
         kw['version'] = self.version.encode('base64')
         self.network_config = kw
+        self._network_config_cache = None
+
+    def _addConfigHistory(self, config):
+        history = self._config_history
+        if not history or history[-1][0] != self.version:
+            history.append((self.version, config))
 
     # The 3 first bits code the number of bytes.
     def encodeVersion(self, version):
@@ -162,16 +196,41 @@ class RegistryServer(object):
     def sendto(self, prefix, code):
         self.sock.sendto("%s\0%c" % (prefix, code), ('::1', tunnel.PORT))
 
-    def recv(self, code):
-        try:
-            prefix, msg = self.sock.recv(1<<16).split('\0', 1)
-            int(prefix, 2)
-        except ValueError:
-            pass
-        else:
-            if msg and ord(msg[0]) == code:
-                return prefix, msg[1:]
-        return None, None
+    def _recvLoop(self):
+        # Replies from nodes, via the local re6stnet, are dispatched
+        # to the threads waiting for them, so that several queries can
+        # be done in parallel.
+        while True:
+            try:
+                prefix, msg = self.sock.recv(1<<16).split('\0', 1)
+                int(prefix, 2)
+            except ValueError:
+                continue
+            if msg:
+                code = ord(msg[0])
+                msg = prefix, msg[1:]
+                with self.sock_lock:
+                    queues = (self._waiters.get((prefix, code), []) +
+                              self._waiters.get((None, code), []))
+                for queue in queues:
+                    queue.put(msg)
+
+    def listen(self, prefix, code):
+        """Return a queue of (prefix, msg) replies
+
+        It must be released with unlisten().
+        """
+        queue = Queue()
+        with self.sock_lock:
+            self._waiters[prefix, code].append(queue)
+        return queue
+
+    def unlisten(self, prefix, code, queue):
+        with self.sock_lock:
+            waiters = self._waiters[prefix, code]
+            waiters.remove(queue)
+            if not waiters:
+                del self._waiters[prefix, code]
 
     def select(self, r, w, t):
         if self.timeout:
@@ -182,13 +241,16 @@ class RegistryServer(object):
         def abort():
             raise ctl.BabelException
         self._wait_dump = True
+        loop = self.ctl_loop
         for _ in 0, 1:
             self.ctl.request_dump()
             try:
                 while self._wait_dump:
-                    args = {}, {}, ((time.time() + 5, abort),)
-                    self.ctl.select(*args)
-                    utils.select(*args)
+                    timer = loop.call_at(time.time() + 5, abort)
+                    try:
+                        loop.run_once()
+                    finally:
+                        timer.cancel()
                 break
             except ctl.BabelException:
                 self.ctl.reset()
@@ -237,6 +299,12 @@ class RegistryServer(object):
                       (prefix,))
                 elif not_after is None or x < not_after:
                     not_after = x
+            # Revoked certificates that expired can be forgotten.
+            if q("DELETE FROM crl WHERE date<=?", (old,)).rowcount:
+                self.updateNetworkConfig()
+            x, = q("SELECT min(date) FROM crl").fetchone()
+            if x is not None and (not_after is None or x < not_after):
+                not_after = x
             # TODO: reduce 'cert' table by merging free slots
             #       (IOW, do the contrary of newPrefix)
             self.timeout = not_after and not_after + GRACE_PERIOD
@@ -252,7 +320,7 @@ class RegistryServer(object):
         key = m.getcallargs(**kw).get('cn')
         if key:
             h = base64.b64decode(request.headers[HMAC_HEADER])
-            with self.lock:
+            with self.sessions_lock:
                 session = self.sessions[key]
                 for key in session:
                     if h == hmac.HMAC(key, request.path, hashlib.sha1).digest():
@@ -264,8 +332,8 @@ class RegistryServer(object):
         else:
             logging.info("%s%s: %s, %s",
                 method,
-                '(' + utils.ipFromBin(x509.networkFromCa(self.cert.ca)
-                                      + kw["client_prefix"])
+                '(' + utils.ipFromPrefix(x509.networkFromCa(self.cert.ca)
+                    + utils.prefixFromBin(kw["client_prefix"]))
                 + ')' if method == 'hello' else '',
                 request.headers.get("X-Forwarded-For") or
                 request.headers.get("host"),
@@ -293,7 +361,8 @@ class RegistryServer(object):
     def hello(self, client_prefix):
         with self.lock:
             cert = self.getCert(client_prefix)
-            key = utils.newHmacSecret()
+        key = utils.newHmacSecret()
+        with self.sessions_lock:
             self.sessions.setdefault(client_prefix, [])[1:] = key,
         key = x509.encrypt(cert, key)
         sign = self.cert.sign(key)
@@ -483,28 +552,83 @@ class RegistryServer(object):
         with open(self.config.dh) as f:
             return f.read()
 
+    def _getNetworkConfig(self, cn):
+        """Return the cached network configuration and HMAC keys for 'cn'"""
+        # All nodes ask for it at the same time when the network
+        # configuration changes, so the common part is compressed once
+        # per version. Only the HMAC keys differ between nodes: they're
+        # encrypted for each one.
+        with self.lock:
+            cert = self.getCert(cn)
+            cache = self._network_config_cache
+            if cache is None:
+                config = json.dumps(self.network_config)
+                assert config[-1] == '}', config
+                compress = zlib.compressobj()
+                hmac = [self.getConfig(k, None) for k in BABEL_HMAC]
+                self._network_config_cache = cache = (
+                    compress, compress.compress(config[:-1]),
+                    [v for v in hmac if v is not None], {})
+        encrypted = cache[3]
+        try:
+            x, hmac = encrypted[cn]
+            if x != cert: # new certificate for this prefix
+                raise KeyError
+        except KeyError:
+            hmac = {k: v and x509.encrypt(cert, v).encode('base64')
+                for k, v in zip(('babel_hmac_sign', 'babel_hmac_accept'),
+                                cache[2])}
+            encrypted[cn] = cert, hmac
+        return cache, hmac
+
     @rpc
     def getNetworkConfig(self, cn):
+        (compress, data, _, _), hmac = self._getNetworkConfig(cn)
+        # Append HMAC keys to the JSON object.
+        compress = compress.copy()
+        return data + compress.compress(''.join(', %s: %s' % (
+            json.dumps(k), json.dumps(v)) for k, v in hmac.iteritems())
+            + '}') + compress.flush()
+
+    @rpc
+    def getNetworkConfigDelta(self, cn, version):
+        """Same as getNetworkConfig, with only what changed since 'version'
+
+        The returned configuration contains:
+        - '-': removed parameters
+        - '+crl' & '-crl': added & removed serials instead of 'crl'
+        The full configuration is returned if 'version' is too old.
+        """
+        version = version.decode('base64')
+        _, hmac = self._getNetworkConfig(cn)
         with self.lock:
-            cert = self.getCert(cn)
-            config = self.network_config.copy()
-            hmac = [self.getConfig(k, None) for k in BABEL_HMAC]
-            for i, v in enumerate(v for v in hmac if v is not None):
-                config[('babel_hmac_sign', 'babel_hmac_accept')[i]] = \
-                    v and x509.encrypt(cert, v).encode('base64')
+            config = self.network_config
+            for x, old in self._config_history:
+                if x == version:
+                    break
+            else:
+                old = None
+        if old is None:
+            return self.getNetworkConfig(cn)
+        config = {k: v for k, v in config.iteritems() if old.get(k) != v}
+        config['-'] = [k for k in old if k not in self.network_config]
+        crl = config.pop('crl', None)
+        if crl is not None:
+            old = set(old.get('crl', ()))
+            config['+crl'] = [x for x in crl if x not in old]
+            config['-crl'] = list(old.difference(crl))
+        config.update(hmac)
         return zlib.compress(json.dumps(config))
 
     def _queryAddress(self, peer):
-        self.sendto(peer, 1)
-        s = self.sock,
-        timeout = 3
-        end = timeout + time.time()
-        # Loop because there may be answers from previous requests.
-        while select.select(s, (), (), timeout)[0]:
-            prefix, msg = self.recv(1)
-            if prefix == peer:
-                return msg
-            timeout = max(0, end - time.time())
+        queue = self.listen(peer, 1)
+        try:
+            self.sendto(peer, 1)
+            return queue.get(timeout=3)[1]
+        except Empty:
+            pass
+        finally:
+            self.unlisten(peer, 1, queue)
         logging.info("Timeout while querying address for %s/%s",
                      int(peer, 2), len(peer))
 
@@ -514,10 +638,7 @@ class RegistryServer(object):
             age, peers = self.peers
             if age < time.time() or not peers:
                 self.request_dump()
-                peers = [prefix
-                    for neigh_routes in self.ctl.neighbours.itervalues()
-                    for prefix in neigh_routes[1]
-                    if prefix]
+                peers = map(str, self.ctl.routes)
                 peers.append(self.prefix)
                 random.shuffle(peers)
                 self.peers = time.time() + 60, peers
@@ -528,10 +649,10 @@ class RegistryServer(object):
                 # (in case 'peers' is empty).
                 peer = self.prefix
         with self.lock:
-            msg = self._queryAddress(peer)
-            if msg is None:
-                return
             cert = self.getCert(cn)
+        msg = self._queryAddress(peer)
+        if msg is None:
+            return
         msg = "%s %s" % (peer, msg)
         logging.info("Sending bootstrap peer: %s", msg)
         return x509.encrypt(cert, msg)
@@ -549,7 +670,8 @@ class RegistryServer(object):
                   (prefix,))
                 cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
                 serial = cert.get_serial_number()
-                self.sessions.pop(prefix, None)
+                with self.sessions_lock:
+                    self.sessions.pop(prefix, None)
             else:
                 cert, = (cert for cert, prefix, email in self.iterCert()
                               if cert.get_serial_number() == serial)
@@ -588,6 +710,8 @@ class RegistryServer(object):
                 1 + self.decodeVersion(self.version))
             self.setConfig('version', buffer(self.version))
             self.network_config['version']  = self.version.encode('base64')
+            self._network_config_cache = None
+            self._addConfigHistory(self._config_history[-1][1])
         self.sendto(self.prefix, 0)
 
     @rpc_private
@@ -605,9 +729,9 @@ class RegistryServer(object):
     def getIPv6Address(self, email):
         cn = self.getNodePrefix(email)
         if cn:
-            return utils.ipFromBin(
+            return utils.ipFromPrefix(
                 x509.networkFromCa(self.cert.ca)
-                + utils.binFromSubnet(cn))
+                + utils.prefixFromSubnet(cn))
 
     @rpc_private
     def getIPv4Information(self, email):
@@ -616,15 +740,10 @@ class RegistryServer(object):
             peer = utils.binFromSubnet(peer)
             with self.peers_lock:
                 self.request_dump()
-                for neigh_routes in self.ctl.neighbours.itervalues():
-                    for prefix in neigh_routes[1]:
-                        if prefix == peer:
-                            break
-                else:
+                if utils.prefixFromBin(peer) not in self.ctl.routes:
                     return
             logging.info("%s %s", email, peer)
-            with self.lock:
-                msg = self._queryAddress(peer)
+            msg = self._queryAddress(peer)
             if msg:
                 return msg.split(',')[0]
 
@@ -632,26 +751,37 @@ class RegistryServer(object):
     def versions(self):
         with self.peers_lock:
             self.request_dump()
-            peers = {prefix
-                for neigh_routes in self.ctl.neighbours.itervalues()
-                for prefix in neigh_routes[1]
-                if prefix}
+            peers = set(map(str, self.ctl.routes))
         peers.add(self.prefix)
-        peer_dict = {}
-        s = self.sock,
-        with self.lock:
+        peer_dict = dict.fromkeys(peers)
+        peers = deque(peers)
+        pending = set()
+        sent = deque() # (deadline, prefix), in order of sending
+        queue = self.listen(None, 4)
+        try:
+            # Queries are paced so that replies are not dropped
+            # on large networks.
             while True:
-                r, w, _ = select.select(s, s if peers else (), (), 3)
-                if r:
-                    prefix, ver = self.recv(4)
-                    if prefix:
-                        peer_dict[prefix] = ver
-                if w:
-                    prefix = peers.pop()
-                    peer_dict[prefix] = None
+                now = time.time()
+                while sent and (sent[0][1] not in pending or
+                                sent[0][0] <= now):
+                    pending.discard(sent.popleft()[1])
+                while peers and len(pending) < self.query_window:
+                    prefix = peers.popleft()
+                    pending.add(prefix)
+                    sent.append((now + 3, prefix))
                     self.sendto(prefix, 4)
-                elif not r:
+                if not sent:
                     break
+                try:
+                    prefix, ver = queue.get(timeout=sent[0][0] - now)
+                except Empty:
+                    continue
+                if prefix in peer_dict:
+                    peer_dict[prefix] = ver
+                    pending.discard(prefix)
+        finally:
+            self.unlisten(None, 4, queue)
         return json.dumps(peer_dict)
 
     @rpc_private
@@ -659,29 +789,29 @@ class RegistryServer(object):
         p = lambda p: '%s/%s' % (int(p, 2), len(p))
         peers = deque((p(self.prefix),))
         graph = defaultdict(set)
-        s = self.sock,
-        with self.lock:
+        queue = self.listen(None, 5)
+        try:
             while True:
-                r, w, _ = select.select(s, s if peers else (), (), 3)
-                if r:
-                    prefix, x = self.recv(5)
-                    if prefix and x:
-                        prefix = p(prefix)
-                        x = x.split()
-                        try:
-                            n = int(x.pop(0))
-                        except ValueError:
-                            continue
-                        if n <= len(x) and prefix not in x:
-                            graph[prefix].update(x[:n])
-                            peers += set(x).difference(graph)
-                            for x in x[n:]:
-                                graph[x].add(prefix)
-                            graph[''].add(prefix)
-                if w:
+                while peers:
                     self.sendto(utils.binFromSubnet(peers.popleft()), 5)
-                elif not r:
-                    break
+                prefix, x = queue.get(timeout=3)
+                if x:
+                    prefix = p(prefix)
+                    x = x.split()
+                    try:
+                        n = int(x.pop(0))
+                    except ValueError:
+                        continue
+                    if n <= len(x) and prefix not in x:
+                        graph[prefix].update(x[:n])
+                        peers += set(x).difference(graph)
+                        for x in x[n:]:
+                            graph[x].add(prefix)
+                        graph[''].add(prefix)
+        except Empty:
+            pass
+        finally:
+            self.unlisten(None, 5, queue)
         return json.dumps({k: list(v) for k, v in graph.iteritems()})
 
 
@@ -19,12 +19,12 @@ shim = None
 def ap_name(prefix):
     # : and - are already used to separate the name from the instance number.
     # Also not using / because the IPCP log path is named after the IPCP name.
-    return "%s.%s.%s" % (IPCP_NAME, int(prefix, 2), len(prefix))
+    return "%s.%s.%s" % (IPCP_NAME, prefix.value, len(prefix))
 
 def ap_prefix(name):
     a, b, c = name.split('.')
     if a == IPCP_NAME:
-        return utils.binFromSubnet(b + '/' + c)
+        return utils.prefixFromSubnet(b + '/' + c)
 
 @apply
 class ipcm(object):
@@ -126,7 +126,7 @@ class Shim(object):
         # have an entry for this neighbour.
         if prefix not in self._enabled:
             ap = ap_name(prefix)
-            ip = utils.ipFromBin(tm._network + prefix, '1')
+            ip = utils.ipFromPrefix(tm._network + prefix, 1)
             port = str(PORT)
             self._kernel(dirEntry="1:%s:%s0:%s:%s%s:%s" % (
                 len(ap), ap, len(ip), ip, len(port), port))
@@ -178,7 +178,7 @@ class Shim(object):
                 self.init(tm)
                 port = str(PORT)
                 self._kernel(
-                    hostname=utils.ipFromBin(tm._network + tm._prefix, '1'),
+                    hostname=utils.ipFromPrefix(tm._network + tm._prefix, 1),
                     expReg="1:%s:%s0:%s:%s" % (len(ap), ap, len(port), port))
                 if step > 3 or not ipcm("register-at-dif", normal_id, self.dif):
                     return
@@ -189,26 +189,25 @@ class Shim(object):
         enrolled = set(ap_prefix(neigh[0].split('-', 1)[0])
             for neigh in ipcm.iterNeigh(normal_id))
         now = time.time()
-        for neigh_routes in tm.ctl.neighbours.itervalues():
-            for prefix in neigh_routes[1]:
-                if not prefix or prefix in enrolled:
+        for prefix in tm.ctl.routes:
+            if prefix in enrolled:
+                continue
+            if prefix in enabled:
+                # Avoid enrollment to a neighbour
+                # that does not know our address.
+                if prefix not in asking_info:
+                    r = ipcm("enroll-to-dif", normal_id,
+                             NORMAL_DIF, self.dif, ap_name(prefix), 1)
+                    if r and 'failed' in r[0]:
+                        del enabled[prefix]
+                    # Enrolling may take a while
+                    # so don't block for too long.
+                    if now + 1 < time.time():
+                        return
                     continue
-                if prefix in enabled:
-                    # Avoid enrollment to a neighbour
-                    # that does not know our address.
-                    if prefix not in asking_info:
-                        r = ipcm("enroll-to-dif", normal_id,
-                                 NORMAL_DIF, self.dif, ap_name(prefix), 1)
-                        if r and 'failed' in r[0]:
-                            del enabled[prefix]
-                        # Enrolling may take a while
-                        # so don't block for too long.
-                        if now + 1 < time.time():
-                            return
-                        continue
-                if asking_info.get(prefix, 0) < now and tm.askInfo(prefix):
-                    self._enroll(tm, prefix)
-                    asking_info[prefix] = now + 60
+            if asking_info.get(prefix, 0) < now and tm.askInfo(prefix):
+                self._enroll(tm, prefix)
+                asking_info[prefix] = now + 60
 
     def enabled(self, tm, prefix, enroll):
         logging.debug("RINA: enabled(%s, %s)", prefix, enroll)
@@ -1,12 +1,18 @@
-import errno, json, logging, os, platform, random, socket
+import errno, fcntl, json, logging, os, platform, random, socket
 import subprocess, struct, sys, time, weakref
 from collections import defaultdict, deque
 from bisect import bisect, insort
+from functools import partial
 from OpenSSL import crypto
-from . import ctl, plib, rina, utils, version, x509
+from . import ctl, netlink, plib, rina, utils, version, x509
 
 PORT = 326
 
+TUNSETIFF = 0x400454ca
+TUNSETPERSIST = 0x400454cb
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+
 family_dict = {
     socket.AF_INET: 'IPv4',
     socket.AF_INET6: 'IPv6',
@@ -31,14 +37,15 @@ def resolve(ip, port, proto):
 
 class MultiGatewayManager(dict):
 
-    def __init__(self, gateway):
+    def __init__(self, gateway, netlink):
         self._gw = gateway
+        self._netlink = netlink
 
     def _route(self, cmd, dest, gw):
         if gw:
-            cmd = 'ip', '-4', 'route', cmd, '%s/32' % dest, 'via', gw
-            logging.trace('%r', cmd)
-            subprocess.check_call(cmd)
+            logging.trace('ip -4 route %s %s/32 via %s', cmd, dest, gw)
+            self._netlink.route(cmd, dest + '/32', gw, ignore=(errno.ESRCH,
+                errno.ENOENT) if cmd == 'del' else ())
 
     def add(self, dest, route):
         try:
@@ -63,13 +70,17 @@ class Connection(object):
 
     _retry = 0
     serial = None
-    time = float('inf')
+    # If there's a free interface, the next address is tried in parallel
+    # when previous attempts are not successful after this delay.
+    race_delay = 5
 
     def __init__(self, tunnel_manager, address_list, iface, prefix):
         self.tunnel_manager = tunnel_manager
         self.address_list = address_list
         self.iface = iface
         self._prefix = prefix
+        # {iface: (process, address index, start time)}
+        self._attempts = {}
 
     def __iter__(self):
         if not hasattr(self, '_remote_ip_set'):
@@ -82,55 +93,103 @@ class Connection(object):
                 self._remote_ip_set.add(ip)
         return iter(self._remote_ip_set)
 
-    def open(self):
+    def open(self, iface=None):
+        """Try the next address, by default on the main interface"""
+        tm = self.tunnel_manager
+        i = self._retry
+        self._retry = i + 1
+        if iface is None:
+            iface = self.iface
+        t = time.time()
+        self._attempts[iface] = self._client(iface, self.address_list[i]), i, t
+        tm.resetTunnelRefresh()
+        if self._retry < len(self.address_list):
+            tm.selectTimeout(t + self.race_delay, self._race)
+
+    def _client(self, iface, address):
         tm = self.tunnel_manager
-        self.time = time.time()
-        self.process = plib.client(
-            self.iface, (self.address_list[self._retry],), tm.encrypt,
+        return plib.client(
+            iface, (address,), tm.encrypt,
             '--verify-x509-name',
-                '%u/%u' % (int(self._prefix, 2), len(self._prefix)), 'name',
+                '%u/%u' % self._prefix, 'name',
             '--resolv-retry', '0',
             '--connect-retry-max', '3', '--tls-exit',
             '--remap-usr1', 'SIGTERM',
             '--ping-exit', str(tm.timeout),
             '--route-up', '%s %u' % (plib.ovpn_client, tm.write_sock.fileno()),
             *tm.ovpn_args)
-        tm.resetTunnelRefresh()
-        self._retry += 1
 
-    def connected(self, serial):
-        cache = self.tunnel_manager.cache
+    def _race(self):
+        if self._retry is not None and self._retry < len(self.address_list):
+            iface = self.tunnel_manager._getExtraInterface(self._prefix)
+            if iface:
+                logging.info('Trying alternate address of %u/%u in parallel',
+                             self._prefix.value, len(self._prefix))
+                self.open(iface)
+
+    def startTime(self, iface):
+        """Return when the attempt on the given interface was started
+
+        route-up notifications that are older than the attempt come from
+        a previous one and must be ignored.
+        """
+        try:
+            return self._attempts[iface][2]
+        except KeyError:
+            return float('inf')
+
+    def connected(self, iface, serial):
+        tm = self.tunnel_manager
+        cache = tm.cache
         if serial in cache.crl:
-            self.tunnel_manager._kill(self._prefix)
+            tm._kill(self._prefix)
             return
         self.serial = serial
-        i = self._retry - 1
+        attempt = self._attempts.pop(iface)
         self._retry = None
+        tm.selectTimeout(None, self._race)
+        # The first successful attempt wins.
+        self._stopAttempts()
+        if iface != self.iface:
+            tm.freeInterface(self.iface)
+            self.iface = iface
+        self._attempts[iface] = attempt
+        i = attempt[1]
         if i:
             cache.addPeer(self._prefix, ','.join(self.address_list[i]), True)
         else:
             cache.connecting(self._prefix, 0)
 
+    def _stopAttempts(self):
+        tm = self.tunnel_manager
+        attempts = self._attempts
+        while attempts:
+            iface, attempt = attempts.popitem()
+            attempt[0].stop()
+            if iface != self.iface:
+                tm.freeInterface(iface)
+
     def close(self):
-        try:
-            self.process.stop()
-        except AttributeError:
-            pass
+        self.tunnel_manager.selectTimeout(None, self._race)
+        self._stopAttempts()
 
     def refresh(self):
         # Check that the connection is alive
-        if self.process.poll() is not None:
+        for iface, (process, i, t) in self._attempts.items():
+            if process.poll() is None:
+                continue
             logging.info('Connection with %s/%s has failed with return code %s',
-                         int(self._prefix, 2), len(self._prefix),
-                         self.process.returncode)
+                         self._prefix.value, len(self._prefix),
+                         process.returncode)
+            del self._attempts[iface]
             if self._retry is None:
                 return 1
-            if len(self.address_list) <= self._retry:
-                return -1
-            logging.info('Retrying with alternate address')
-            self.close()
-            self.open()
-        return 0
+            if self._retry < len(self.address_list):
+                logging.info('Retrying with alternate address')
+                self.open(iface)
+            elif iface != self.iface:
+                self.tunnel_manager.freeInterface(iface)
+        return 0 if self._attempts else -1
 
 class TunnelKiller(object):
 
@@ -186,18 +245,158 @@ class TunnelKiller(object):
     locked = unlocking = lambda _: None
 
 
+class HelloAdmission(object):
+    """Queue of hello0 packets waiting for their certificate to be verified
+
+    Each source has a token bucket, to limit the number of packets it can
+    make us verify. Packets from already known peers have priority: when the
+    queue is full, they replace the oldest packet from an unknown source.
+    'deferred' and 'dropped' count queued and rejected packets.
+    """
+
+    deferred = dropped = 0
+
+    def __init__(self, rate=1, burst=4, size=64):
+        self._rate = rate
+        self._burst = burst
+        self._size = size
+        self._bucket = {}
+        self._queue = deque(), deque() # known, unknown
+
+    def __len__(self):
+        return sum(map(len, self._queue))
+
+    def push(self, source, known, item):
+        now = time.time()
+        bucket = self._bucket
+        if len(bucket) > 4 * self._size:
+            # Forget sources whose bucket is full again.
+            full = now - self._burst / float(self._rate)
+            for k, (tokens, last) in bucket.items():
+                if last < full:
+                    del bucket[k]
+        tokens, last = bucket.get(source, (self._burst, now))
+        tokens = min(self._burst, tokens + (now - last) * self._rate)
+        if tokens < 1:
+            self._drop(source)
+            return False
+        bucket[source] = tokens - 1, now
+        known_queue, unknown_queue = self._queue
+        if self._size <= len(self):
+            if not (known and unknown_queue):
+                self._drop(source)
+                return False
+            self._drop(unknown_queue.popleft()[1][0])
+        (known_queue if known else unknown_queue).append(item)
+        self.deferred += 1
+        return True
+
+    def _drop(self, source):
+        self.dropped += 1
+        logging.trace("hello0 from %s dropped (%u deferred, %u dropped)",
+                      source, self.deferred, self.dropped)
+
+    def pop(self):
+        for queue in self._queue:
+            if queue:
+                return queue.popleft()
+
+
+class RandomStrategy(object):
+    """Choose peers to connect to, and tunnels to remove
+
+    Peers are chosen randomly, and the tunnel that is removed is the one
+    via which babeld routes the fewest nodes. In both cases, peers given
+    with --neighbour are preferred.
+    """
+
+    def __init__(self, tunnel_manager):
+        self.tm = weakref.proxy(tunnel_manager)
+
+    def newTunnelScore(self, prefix):
+        """The peer with the highest score is connected first"""
+        return (prefix in self.tm._neighbour_set) + random.random()
+
+    def _routeCount(self, prefix):
+        n = 0
+        try:
+            for x in self.tm.ctl.neighbours[prefix][1]:
+                # Ignore the default route, which is redundant with the
+                # border gateway node.
+                if x:
+                    n += 1
+        except KeyError:
+            # XXX: The route for this neighbour is not direct. In this case,
+            #      a KeyError was raised because babeld dump doesn't give us
+            #      enough information to match the neighbour prefix with its
+            #      link-local address. This is a good candidate (so we return
+            #      ()), but for the same reason, such tunnel can't be killed.
+            #      In order not to remain indefinitely in a state where we
+            #      never delete any tunnel because we would always select an
+            #      unkillable one, we should return an higher score.
+            pass
+        return n
+
+    def tunnelScore(self, prefix):
+        """The tunnel with the lowest score is removed first"""
+        # First try to not kill a persistent tunnel (see --neighbour option).
+        # Then sort by the number of routed nodes.
+        n = self._routeCount(prefix)
+        return (prefix in self.tm._neighbour_set, n) if n else ()
+
+
+class MetricStrategy(RandomStrategy):
+    """Use the metrics measured by babeld
+
+    The farther a peer is, the more likely we connect to it, since such
+    a tunnel shortens more paths. Randomness is kept so that all nodes
+    don't connect to the same distant peers. Among tunnels that route the
+    same number of nodes, the one with the highest RTT is removed first.
+    """
+
+    def newTunnelScore(self, prefix):
+        tm = self.tm
+        try:
+            metric = tm.ctl.routes[prefix].metric
+        except KeyError:
+            metric = 0
+        return (prefix in tm._neighbour_set,
+                random.random() * (1 + metric))
+
+    def tunnelScore(self, prefix):
+        n = self._routeCount(prefix)
+        if n:
+            neigh = self.tm.ctl.neighbours[prefix][0]
+            return prefix in self.tm._neighbour_set, n, -neigh.rtt
+        return ()
+
+
+tunnel_strategy_dict = {
+    'random': RandomStrategy,
+    'metric': MetricStrategy,
+}
+
+
 class BaseTunnelManager(object):
 
     # TODO: To minimize downtime when network parameters change, we should do
-    #       our best to not restart any process. Ideally, this list should be
-    #       empty and the affected subprocesses reloaded.
-    NEED_RESTART = frozenset(('babel_default', 'babel_hmac_accept',
-                              'babel_hmac_sign', 'encrypt',
-                              'hello', 'ipv4', 'ipv4_sublen'))
+    #       our best to not restart re6stnet. Ideally, this list should be
+    #       empty. Parameters that can be applied live are handled by
+    #       _reloadConfig, which may restart supervised processes.
+    NEED_RESTART = frozenset(('encrypt', 'hello', 'ipv4', 'ipv4_sublen'))
+    # Parameters given to babeld at command line, so it is restarted.
+    BABEL_PARAMETERS = frozenset(('babel_default', 'babel_hmac_accept',
+                                  'babel_hmac_sign'))
+
+    # Supervised processes, if any (see utils.ManagedProcess).
+    babeld = None
+    servers = ()
 
     _geoiplookup = None
     _forward = None
     _next_rina = True
+    _loop = None
+    _routes_changed = True
 
     def __init__(self, control_socket, cache, cert, address=()):
         self.cert = cert
@@ -208,6 +407,13 @@ class BaseTunnelManager(object):
         self._connection_dict = {}
         self._served = defaultdict(dict)
         self._version = cache.version
+        # Supervised processes to restart with new network parameters.
+        self._reload_queue = deque()
+        self._hello0_queue = HelloAdmission()
+        self._hello0_pending = 0
+        # Crypto of the peer protocol. Results are processed by the main
+        # thread, which is the only one to change the state of peers.
+        self._workers = utils.WorkerPool()
 
         address_dict = defaultdict(list)
         for family, address in address:
@@ -248,34 +454,40 @@ class BaseTunnelManager(object):
         # See also http://stackoverflow.com/questions/597225/
         # about binding and anycast.
         self.sock.bind(('::', PORT))
+        self._netlink = netlink.Netlink()
 
         p = x509.Peer(self._prefix)
         p.stop_date = cache.next_renew
         self._peers = [p]
-        self._timeouts = [(p.stop_date, self.invalidatePeers)]
+        self._timeouts = {}
+        self.selectTimeout(p.stop_date, self.invalidatePeers)
 
         self.ctl = ctl.Babel(control_socket, weakref.proxy(self), self._network)
 
         # Only to check routing cache. Should go back to
         # TunnelManager when we don't need to check it anymore.
-        self._next_refresh = time.time()
+        self.selectTimeout(time.time(), self.refresh)
 
     def close(self):
         self.sock.close()
+        self._netlink.close()
         self.ctl.close()
+        self._workers.close()
 
-    def select(self, r, w, t):
-        r[self.sock] = self.handlePeerEvent
-        t += self._timeouts
-        if self._next_refresh: # same comment as in __init__
-            t.append((self._next_refresh, self.refresh))
-        self.ctl.select(r, w, t)
+    def register(self, loop):
+        self._loop = loop
+        loop.register(self.sock, self.handlePeerEvent)
+        self._workers.register(loop)
+        self.ctl.register(loop)
+        t = self._timeouts
+        for callback, timer in t.items():
+            t[callback] = loop.call_at(timer.when, timer.callback)
 
     def refresh(self):
         if self._next_rina and rina.update(self, False):
             self._next_rina = False
             self.__request_dump('rina')
-        self._next_refresh = time.time() + self.cache.hello
+        self.selectTimeout(time.time() + self.cache.hello, self.refresh)
         self.checkRoutingCache()
 
     def __request_dump(self, reason):
@@ -297,18 +509,31 @@ class BaseTunnelManager(object):
         self.__requesting_dump.clear()
 
     def selectTimeout(self, next, callback, force=True):
+        # There is at most 1 timer per callback. Each one is called once
+        # and it is up to the callback to schedule itself again.
         t = self._timeouts
-        for i, x in enumerate(t):
-            if x[1] == callback:
-                if not next:
-                    logging.debug("timeout: removing %r (%s)", callback.__name__, next)
-                    del t[i]
-                elif force or next < x[0]:
-                    logging.debug("timeout: updating %r (%s)", callback.__name__, next)
-                    t[i] = next, callback
+        if next == float('inf'):
+            next = None
+        timer = t.get(callback)
+        if timer:
+            if next and not force and timer.when <= next:
                 return
-        logging.debug("timeout: adding %r (%s)", callback.__name__, next)
-        t.append((next, callback))
+            logging.debug("timeout: %s %r (%s)", "updating" if next else
+                          "removing", callback.__name__, next)
+            timer.cancel()
+            del t[callback]
+        elif not next:
+            return
+        else:
+            logging.debug("timeout: adding %r (%s)", callback.__name__, next)
+        if next:
+            timer = partial(self._timeout, callback)
+            t[callback] = (self._loop.call_at(next, timer) if self._loop else
+                           utils.Timer(next, timer))
+
+    def _timeout(self, callback):
+        del self._timeouts[callback]
+        callback()
 
     def invalidatePeers(self):
         next = float('inf')
@@ -329,7 +554,7 @@ class BaseTunnelManager(object):
         return self._peers[bisect(self._peers, prefix) - 1]
 
     def sendto(self, prefix, msg):
-        to = utils.ipFromBin(self._network + prefix), PORT
+        to = utils.ipFromPrefix(self._network + prefix), PORT
         peer = self._getPeer(prefix)
         if peer.prefix != prefix:
             peer = x509.Peer(prefix)
@@ -359,7 +584,7 @@ class BaseTunnelManager(object):
         if address[0] == '::1':
             try:
                 prefix, msg = msg.split('\0', 1)
-                int(prefix, 2)
+                prefix = utils.prefixFromBin(prefix)
             except ValueError:
                 return
             if msg:
@@ -373,12 +598,12 @@ class BaseTunnelManager(object):
                     self.sendto(prefix, chr(code | 0x80) + msg[1:])
             return
         try:
-            sender = utils.binFromIp(address[0])
+            sender = utils.prefixFromIp(address[0])
         except socket.error, e:
             return # inet_pton does not parse '<ipv6>%<iface>'
         if len(msg) <= 4 or not sender.startswith(self._network):
             return
-        prefix = sender[len(self._network):]
+        prefix = utils.prefixFromIntIp(sender.value, len(self._network), 128)
         peer = self._getPeer(prefix)
         msg = peer.decode(msg)
         if type(msg) is tuple:
@@ -386,56 +611,108 @@ class BaseTunnelManager(object):
             if seqno == 2:
                 i = len(msg) // 2
                 h = msg[:i]
+                def newSession(result):
+                    try:
+                        peer.newSession(result())
+                    except (crypto.Error, x509.NewSessionError,
+                            subprocess.CalledProcessError, ValueError):
+                        logging.debug('ignored new session key from %r',
+                                      address, exc_info=1)
+                        return
+                    peer.version = self._version \
+                        if self._sendto(to, '\0' + self._version, peer) else ''
                 try:
-                    peer.verify(msg[i:], h)
-                    peer.newSession(self.cert.decrypt(h))
-                except (AttributeError, crypto.Error, x509.NewSessionError,
-                        subprocess.CalledProcessError):
-                    logging.debug('ignored new session key from %r',
-                                  address, exc_info=1)
+                    cert = peer.cert
+                except AttributeError:
+                    logging.debug('ignored new session key from %r'
+                                  ' (unknown certificate)', address)
                     return
-                peer.version = self._version \
-                    if self._sendto(to, '\0' + self._version, peer) else ''
+                def decrypt(cert, sign, h):
+                    crypto.verify(cert, sign, h, 'sha512')
+                    return self.cert.decrypt(h)
+                self._workers.submit(newSession, decrypt, cert, msg[i:], h)
                 return
-            if seqno:
-                h = x509.fingerprint(self.cert.cert).digest()
-                seqno = msg.startswith(h)
-                msg = msg[len(h):]
-            try:
-                cert = self.cert.loadVerify(msg,
-                    True, crypto.FILETYPE_ASN1)
-                stop_date = x509.notAfter(cert)
-                serial = cert.get_serial_number()
-                if serial in self.cache.crl:
-                    raise ValueError("revoked")
-            except (x509.VerifyError, ValueError), e:
-                logging.debug('ignored invalid certificate from %r (%s)',
-                              address, e.args[-1])
-                return
-            p = utils.binFromSubnet(x509.subnetFromCert(cert))
-            if p != peer.prefix:
-                if not prefix.startswith(p):
-                    logging.debug('received %s/%s cert from wrong source %r',
-                                  int(p, 2), len(p), address)
-                    return
-                peer = x509.Peer(p)
-                insort(self._peers, peer)
-            peer.cert = cert
-            peer.serial = serial
-            peer.stop_date = stop_date
-            self.selectTimeout(stop_date, self.invalidatePeers, False)
-            if seqno:
-                self._sendto(to, peer.hello(self.cert))
-            else:
-                msg = peer.hello0(self.cert.cert)
-                if msg and self._sendto(to, msg):
-                    peer.hello0Sent()
+            # Certificate verification is expensive and hello0 packets can
+            # be sent by anyone, so they are queued and processed later.
+            if self._hello0_queue.push(address[0],
+                    prefix.startswith(peer.prefix) and (
+                        peer.serial is not None or
+                        peer.prefix in getattr(self.ctl, 'neighbours', ())),
+                    (to, address, prefix, seqno, msg)):
+                self.selectTimeout(time.time(), self._processHello0, False)
         elif msg:
             # We got a valid and non-empty message. Always reply
             # something so that the sender knows we're still connected.
             answer = self._processPacket(msg, peer.prefix)
             self._sendto(to, msg[0] + answer if answer else "", peer)
 
+    def _processHello0(self):
+        # Certificates are verified by worker threads. Only a few at a time,
+        # so that we keep the control of what is processed first.
+        queue = self._hello0_queue
+        while queue and self._hello0_pending < 4:
+            self._hello0(*queue.pop())
+        self.selectTimeout(None, self._processHello0)
+
+    def _hello0(self, to, address, prefix, seqno, msg):
+        if seqno:
+            h = x509.fingerprint(self.cert.cert).digest()
+            seqno = msg.startswith(h)
+            msg = msg[len(h):]
+        x = self.cert.verified.get(msg)
+        if x:
+            return self._hello0Verified(to, address, prefix, seqno, x)
+        def verified(result):
+            self._hello0_pending -= 1
+            if self._hello0_queue:
+                self.selectTimeout(time.time(), self._processHello0, False)
+            try:
+                x = self.cert.verified.add(msg, result())
+            except x509.VerifyError, e:
+                logging.debug('ignored invalid certificate from %r (%s)',
+                              address, e.args[-1])
+            else:
+                self._hello0Verified(to, address, prefix, seqno, x)
+        self._hello0_pending += 1
+        self._workers.submit(verified, self.cert.loadVerify,
+                             msg, True, crypto.FILETYPE_ASN1)
+
+    def _hello0Verified(self, to, address, prefix, seqno, verified):
+        cert, stop_date, serial, subnet = verified
+        if serial in self.cache.crl:
+            logging.debug('ignored invalid certificate from %r (revoked)',
+                          address)
+            return
+        peer = self._getPeer(prefix)
+        p = utils.prefixFromSubnet(subnet)
+        if p != peer.prefix:
+            if not prefix.startswith(p):
+                logging.debug('received %s/%s cert from wrong source %r',
+                              p.value, len(p), address)
+                return
+            peer = x509.Peer(p)
+            insort(self._peers, peer)
+        peer.cert = cert
+        peer.serial = serial
+        peer.stop_date = stop_date
+        self.selectTimeout(stop_date, self.invalidatePeers, False)
+        if seqno:
+            def hello(result):
+                try:
+                    result = result()
+                except (crypto.Error, subprocess.CalledProcessError,
+                        ValueError):
+                    logging.debug('failed to create a session key for %r',
+                                  address, exc_info=1)
+                else:
+                    self._sendto(to, peer.hello(*result))
+            self._workers.submit(hello,
+                x509.Peer.newSessionKey, self.cert, cert)
+        else:
+            msg = peer.hello0(self.cert.cert)
+            if msg and self._sendto(to, msg):
+                peer.hello0Sent()
+
     def _processPacket(self, msg, peer=None):
         c = ord(msg[0])
         msg = msg[1:]
@@ -501,13 +778,13 @@ class BaseTunnelManager(object):
             # the registry wants to know the topology for debugging purpose
             if not peer or peer == self.cache.registry_prefix:
                 return str(len(self._connection_dict)) + ''.join(
-                    ' %s/%s' % (int(x, 2), len(x))
+                    ' %u/%u' % x
                     for x in (self._connection_dict, self._served)
                     for x in x)
         elif code == 7:
             # XXX: Quick'n dirty way to log in a common place.
             if peer and self._prefix == self.cache.registry_prefix:
-                logging.info("%s/%s: %s", int(peer, 2), len(peer), msg)
+                logging.info("%u/%u: %s", peer.value, len(peer), msg)
 
     def askInfo(self, prefix):
         return self.sendto(prefix, '\4' + self._info(True))
@@ -548,6 +825,8 @@ class BaseTunnelManager(object):
         self._version = self.cache.version
         self.broadcastNewVersion()
         self.cache.warnProtocol()
+        if 'crl' in changed or 'crl_ranges' in changed:
+            self.cert.verified.clear()
         crl = self.cache.crl
         for i in reversed([i for i, peer in enumerate(self._peers)
                              if peer.serial in crl]):
@@ -555,7 +834,7 @@ class BaseTunnelManager(object):
         if self.cert.cert.get_serial_number() in crl:
             raise utils.ReexecException("Our certificate has just been revoked."
                 " Let's try to renew it.")
-        if (not self.NEED_RESTART.isdisjoint(changed)
+        if (self._reloadConfig(changed)
             or version.protocol < self.cache.min_protocol
             # TODO: With --management, we could kill clients without restarting.
             or not all(crl.isdisjoint(serials.itervalues())
@@ -563,6 +842,34 @@ class BaseTunnelManager(object):
             # Wait at least 1 second to broadcast new version to neighbours.
             self.selectTimeout(time.time() + 1 + self.cache.delay_restart,
                                self._restart)
+        elif self._reload_queue:
+            # Same delay as above, and restarting babeld would break routes.
+            self.selectTimeout(time.time() + 1 + self.cache.delay_restart,
+                               self._reloadProcess)
+
+    def _reloadConfig(self, changed):
+        """Apply new network parameters that do not require a restart
+
+        Return whether a restart is required.
+        """
+        if self.babeld and not self.BABEL_PARAMETERS.isdisjoint(changed):
+            self._reload(self.babeld)
+        return not self.NEED_RESTART.isdisjoint(changed)
+
+    def _reload(self, process):
+        if process not in self._reload_queue:
+            self._reload_queue.append(process)
+
+    def _reloadProcess(self):
+        # One at a time, so that while an OpenVPN server restarts,
+        # tunnels via the other ones remain.
+        process = self._reload_queue.popleft()
+        logging.info("Restarting %s with new network parameters",
+                     process.name)
+        process.restart()
+        if self._reload_queue:
+            self.selectTimeout(time.time() + self.cache.hello,
+                               self._reloadProcess)
 
     def handleServerEvent(self, sock):
         event, args = eval(sock.recv(65536))
@@ -571,21 +878,31 @@ class BaseTunnelManager(object):
         if r is not None:
             sock.send(chr(r))
 
+    def babeldRestarted(self):
+        self.ctl.reset()
+
+    def serverRestarted(self, iface):
+        # Clients of the previous process are gone without notification.
+        for prefix, serials in self._served.items():
+            if serials.pop(iface, None) is not None:
+                self._clientGone(prefix, iface, serials)
+
     def _ovpn_client_connect(self, common_name, iface, serial, trusted_ip):
         if serial in self.cache.crl:
             return False
-        prefix = utils.binFromSubnet(common_name)
+        prefix = utils.prefixFromSubnet(common_name)
         self._served[prefix][iface] = serial
         if isinstance(self, TunnelManager): # XXX
             if self._gateway_manager is not None:
                 self._gateway_manager.add(trusted_ip, False)
+                self._served_ip[prefix, iface] = trusted_ip
             if prefix in self._connection_dict and self._prefix < prefix:
                 self._kill(prefix)
                 self.cache.connecting(prefix, 0)
         return True
 
     def _ovpn_client_disconnect(self, common_name, iface, serial, trusted_ip):
-        prefix = utils.binFromSubnet(common_name)
+        prefix = utils.prefixFromSubnet(common_name)
         serials = self._served.get(prefix)
         try:
             del serials[iface]
@@ -593,12 +910,19 @@ class BaseTunnelManager(object):
             logging.exception("ovpn_client_disconnect%r",
                               (common_name, iface, serial, trusted_ip))
             return
+        self._clientGone(prefix, iface, serials)
+
+    def _clientGone(self, prefix, iface, serials):
         if not serials:
             del self._served[prefix]
         if isinstance(self, TunnelManager): # XXX
             self._abortTunnelKiller(prefix, iface)
             if self._gateway_manager is not None:
-                self._gateway_manager.remove(trusted_ip)
+                self._gateway_manager.remove(
+                    self._served_ip.pop((prefix, iface)))
+
+    def babel_routes(self, added, removed, changed):
+        self._routes_changed = True
 
     def checkRoutingCache(self):
         # WRKD: Check that routes in cache match the routing table.
@@ -608,37 +932,40 @@ class BaseTunnelManager(object):
         #       babeld has a distinct issue (no atomic update of route) that
         #       increases the probability of invalid entries in the cache:
         #        https://lists.alioth.debian.org/pipermail/babel-users/2016-June/002547.html
-        with open('/proc/net/ipv6_route', "r", 4096) as f:
-            try:
-                routing_table = f.read()
-            except IOError, e:
-                # ???: If someone can explain why the kernel sometimes fails
-                #      even when there's a lot of free memory.
-                if e.errno != errno.ENOMEM:
-                    raise
-                logging.error("Ignoring ENOMEM when checking routing cache")
-                return
+        # Entries can only become invalid when babeld changes routes, so
+        # the (big) routing table is not dumped if it didn't change.
+        if not self._routes_changed:
+            return
+        self._routes_changed = False
         cache = []
         other = []
         n = self._network
         a = len(n)
-        for line in routing_table.splitlines():
-            line = line.split()
-            dst = bin(int(line[0], 16))[2:].rjust(128, '0')
-            if dst.startswith(n):
-                flags = int(line[8], 16)
-                if not (flags & 0x80000000): # RTF_LOCAL
-                    (cache if flags & 0x1000000 # RTF_CACHE
-                     else other).append((dst[a:int(line[1], 16)], line[4]))
+        shift = 128 - a
+        network = n.value
+        # Since Linux 5.3, cached routes are only dumped on request,
+        # and then, without the other ones.
+        for cloned in False, True:
+            for route in self._netlink.iterRoutes(cloned=cloned):
+                dst = route.dst
+                if (dst is None or route.type == netlink.RTN_LOCAL
+                    or cloned and not route.cloned):
+                    continue
+                dst = utils.intFromRawIp(dst)
+                if dst >> shift == network:
+                    (cache if route.cloned else other).append((
+                        utils.prefixFromIntIp(dst, a, route.dst_len),
+                        route.gateway))
         other.sort()
         for dst, via in cache:
             i = bisect(other, (dst,))
             if i == len(other) or dst < other[i][0]:
                 i -= 1
             if dst.startswith(other[i][0]) and via != other[i][1]:
-                msg = "Invalid route in cache for " + utils.ipFromBin(n + dst)
+                msg = ("Invalid route in cache for "
+                       + utils.ipFromPrefix(n + dst))
                 logging.error("%s. Flushing...", msg)
-                subprocess.call(("ip", "-6", "route", "flush", "cached"))
+                netlink.flushRouteCache()
                 self.sendto(self.cache.registry_prefix,
                     '\7%s (%s)' % (msg, os.uname()[2]))
                 break
@@ -658,12 +985,15 @@ class BaseTunnelManager(object):
 
 class TunnelManager(BaseTunnelManager):
 
-    NEED_RESTART = BaseTunnelManager.NEED_RESTART.union((
-        'client_count', 'max_clients', 'same_country', 'tunnel_refresh'))
+    # Interfaces in addition to those for client tunnels, so that alternate
+    # addresses of a peer can be tried in parallel (see Connection._race).
+    race_iface_count = 2
 
     def __init__(self, control_socket, cache, cert, openvpn_args,
                  timeout, client_count, iface_list, address, ip_changed,
-                 remote_gateway, disable_proto, neighbour_list=()):
+                 remote_gateway, disable_proto, neighbour_list=(),
+                 auto_client_count=False, strategy='random',
+                 auto_max_clients=False):
         super(TunnelManager, self).__init__(control_socket,
                                             cache, cert, address)
         self.ovpn_args = openvpn_args
@@ -676,17 +1006,22 @@ class TunnelManager(BaseTunnelManager):
         self._iface_to_prefix = {}
         self._iface_list = iface_list
         self._ip_changed = ip_changed
-        self._gateway_manager = MultiGatewayManager(remote_gateway) \
-                                if remote_gateway else None
+        self._gateway_manager = MultiGatewayManager(remote_gateway,
+            self._netlink) if remote_gateway else None
+        self._served_ip = {}
         self._disable_proto = disable_proto
-        self._neighbour_set = set(map(utils.binFromSubnet, neighbour_list))
+        self._neighbour_set = set(map(utils.prefixFromSubnet, neighbour_list))
+        self._strategy = tunnel_strategy_dict[strategy](self)
         self._killing = {}
 
         self.resetTunnelRefresh()
 
         self._client_count = client_count
+        self._auto_client_count = auto_client_count
+        self._auto_max_clients = auto_max_clients
+        self._iface_count = client_count
         self.new_iface_list = deque('re6stnet' + str(i)
-            for i in xrange(1, self._client_count + 1))
+            for i in xrange(1, client_count + self.race_iface_count + 1))
         self._free_iface_list = []
 
     def close(self):
@@ -700,34 +1035,78 @@ class TunnelManager(BaseTunnelManager):
     def encrypt(self):
         return self.cache.encrypt
 
+    def _reloadConfig(self, changed):
+        restart = super(TunnelManager, self)._reloadConfig(changed)
+        cache = self.cache
+        if 'same_country' in changed and cache.same_country \
+           and not self._geoiplookup:
+            restart = True # so that re6stnet fails like at startup
+        if 'client_count' in changed and self._auto_client_count:
+            # babeld only knows the interfaces created at startup.
+            if self._iface_count < cache.client_count:
+                restart = True
+            else:
+                logging.info("Number of client tunnels: %s -> %s",
+                             self._client_count, cache.client_count)
+                if cache.client_count < self._client_count:
+                    # Tunnels in excess are removed at the next refresh.
+                    self._next_tunnel_refresh = time.time()
+                self._client_count = cache.client_count
+        if 'tunnel_refresh' in changed:
+            self._next_tunnel_refresh = min(self._next_tunnel_refresh,
+                time.time() + cache.tunnel_refresh)
+        if 'max_clients' in changed and self._auto_max_clients:
+            if bool(self.servers) != bool(cache.max_clients):
+                restart = True # OpenVPN servers must be started or stopped
+            else:
+                for server in self.servers:
+                    self._reload(server)
+        return restart
+
     def resetTunnelRefresh(self):
         self._next_tunnel_refresh = time.time() + self.cache.tunnel_refresh
 
-    def _tuntap(self, iface=None):
-        if iface:
-            self.new_iface_list.appendleft(iface)
-            action = '--rmtun'
-        else:
-            iface = self.new_iface_list.popleft()
-            action = '--mktun'
-        # BBB: do not use 'ip tuntap' which is not available on old dists
-        args = ('openvpn', action, '--verb', '0',
-                '--dev', iface, '--dev-type', 'tap')
-        logging.debug('%r', args)
-        subprocess.check_call(args)
+    def _tuntap(self):
+        # Same as 'openvpn --mktun --dev-type tap', without forking.
+        iface = self.new_iface_list.popleft()
+        logging.debug('Creating interface %s', iface)
+        fd = os.open('/dev/net/tun', os.O_RDWR)
+        try:
+            fcntl.ioctl(fd, TUNSETIFF,
+                        struct.pack('16sH', iface, IFF_TAP | IFF_NO_PI))
+            fcntl.ioctl(fd, TUNSETPERSIST, 1)
+        finally:
+            os.close(fd)
         return iface
 
+    def createInterfaces(self):
+        # Creating interfaces is cheap so do it now for all of them,
+        # instead of delaying the first tunnels.
+        iface_list = self._free_iface_list
+        while self.new_iface_list:
+            iface_list.append(self._tuntap())
+        iface_list.reverse()
+
     def delInterfaces(self):
         iface_list = self._free_iface_list
         iface_list += self._iface_to_prefix
         self._iface_to_prefix.clear()
+        try:
+            with self._netlink:
+                for iface in iface_list:
+                    logging.debug('Deleting interface %s', iface)
+                    self._netlink.delLink(iface, ignore=(errno.ENODEV,))
+        except netlink.NetlinkError, e:
+            logging.warning('Failed to delete interfaces (%s)', e)
         while iface_list:
-          self._tuntap(iface_list.pop())
+            self.new_iface_list.appendleft(iface_list.pop())
 
     def _getFreeInterface(self, prefix):
         try:
             iface = self._free_iface_list.pop()
         except IndexError:
+            if not self.new_iface_list:
+                return
             iface = self._tuntap()
         self._iface_to_prefix[iface] = prefix
         return iface
@@ -736,9 +1115,17 @@ class TunnelManager(BaseTunnelManager):
         self._free_iface_list.append(iface)
         del self._iface_to_prefix[iface]
 
-    def select(self, r, w, t):
-        super(TunnelManager, self).select(r, w, t)
-        r[self._read_sock] = self.handleClientEvent
+    def _getExtraInterface(self, prefix):
+        # Only use an interface that is not needed for the tunnels
+        # that remain to be established (including those to peers
+        # in self._connecting, which are not in self._connection_dict yet).
+        if (len(self._free_iface_list) + len(self.new_iface_list) >
+            max(0, self._client_count - len(self._connection_dict))):
+            return self._getFreeInterface(prefix)
+
+    def register(self, loop):
+        super(TunnelManager, self).register(loop)
+        loop.register(self._read_sock, self.handleClientEvent)
 
     def refresh(self):
         logging.debug('Checking tunnels...')
@@ -746,10 +1133,10 @@ class TunnelManager(BaseTunnelManager):
            self._next_tunnel_refresh < time.time() or \
            self._killing or \
            self._makeNewTunnels(False):
-            self._next_refresh = None
+            self.selectTimeout(None, self.refresh)
             self.ctl.request_dump() # calls babel_dump immediately at startup
         else:
-            self._next_refresh = time.time() + 5
+            self.selectTimeout(time.time() + 5, self.refresh)
         self.checkRoutingCache()
 
     def babel_dump(self):
@@ -761,15 +1148,15 @@ class TunnelManager(BaseTunnelManager):
                         logging.info(
                             'Abort destruction of tunnel %s %s/%s (state: %s)',
                             'to' if tunnel_killer.client else 'from',
-                            int(prefix, 2), len(prefix), tunnel_killer.state)
+                            prefix.value, len(prefix), tunnel_killer.state)
                     tunnel_killer.unlock()
                     del self._killing[prefix]
                 else:
                     tunnel_killer()
         remove = self._next_tunnel_refresh < t
         if remove:
-            self._removeSomeTunnels()
             self.resetTunnelRefresh()
+            self._removeSomeTunnels()
             self.cache.log()
         self._makeNewTunnels(True)
         # XXX: Commented code is an attempt to clean up unused interfaces
@@ -779,9 +1166,18 @@ class TunnelManager(BaseTunnelManager):
         #      to see each other.
         #if remove and len(self._connecting) < len(self._free_iface_list):
         #    self._tuntap(self._free_iface_list.pop())
-        self._next_refresh = time.time() + 5
+        self.selectTimeout(time.time() + 5, self.refresh)
         rina.update(self, True)
 
+    def childExited(self):
+        # Do not wait the next refresh to replace failed tunnels, whether
+        # they were established or not. Retries with alternate addresses
+        # are already done by _cleanDeads.
+        count = len(self._connection_dict)
+        self._cleanDeads()
+        if len(self._connection_dict) < count:
+            self.selectTimeout(time.time(), self.refresh)
+
     def _cleanDeads(self):
         disconnected = False
         for prefix in self._connection_dict.keys():
@@ -791,69 +1187,60 @@ class TunnelManager(BaseTunnelManager):
                 self._kill(prefix)
         return disconnected
 
-    def _tunnelScore(self, prefix):
-        # First try to not kill a persistent tunnel (see --neighbour option).
-        # Then sort by the number of routed nodes.
-        n = 0
-        try:
-            for x in self.ctl.neighbours[prefix][1]:
-                # Ignore the default route, which is redundant with the
-                # border gateway node.
-                if x:
-                    n += 1
-        except KeyError:
-            # XXX: The route for this neighbour is not direct. In this case,
-            #      a KeyError was raised because babeld dump doesn't give us
-            #      enough information to match the neighbour prefix with its
-            #      link-local address. This is a good candidate (so we return
-            #      ()), but for the same reason, such tunnel can't be killed.
-            #      In order not to remain indefinitely in a state where we
-            #      never delete any tunnel because we would always select an
-            #      unkillable one, we should return an higher score.
-            pass
-        return (prefix in self._neighbour_set, n) if n else ()
-
     def _removeSomeTunnels(self):
         # Get the candidates to killing
         peer_set = set(self._connection_dict)
         peer_set.difference_update(self._killing)
         # Keep only a small number of tunnels if server is not reachable
         # (user should configure NAT properly).
-        if (self._client_count if self._served or self._disconnected else
-              min(2, self._client_count)) <= len(peer_set):
-            prefix = min(peer_set, key=self._tunnelScore)
+        count = (self._client_count if self._served or self._disconnected else
+                 min(2, self._client_count))
+        if count <= len(peer_set):
+            prefix = min(peer_set, key=self._strategy.tunnelScore)
             self._killing[prefix] = TunnelKiller(prefix, self, True)
+            if count < len(peer_set):
+                # Tunnels in excess (e.g. the number of client tunnels was
+                # lowered) are removed one by one, without waiting a full
+                # tunnel refresh between each.
+                self._next_tunnel_refresh = time.time() + self.timeout
 
     def _abortTunnelKiller(self, prefix, iface=None):
         tunnel_killer = self._killing.get(prefix)
         if tunnel_killer:
             if tunnel_killer.state:
                 if not iface or \
-                   iface == self.ctl.interfaces[tunnel_killer.ifindex]:
+                   iface == self.ctl.interfaces.get(tunnel_killer.ifindex):
                     tunnel_killer.abort()
             else:
                 del self._killing[prefix]
 
     def _kill(self, prefix):
         logging.info('Killing the connection with %u/%u...',
-                     int(prefix, 2), len(prefix))
+                     prefix.value, len(prefix))
         self._abortTunnelKiller(prefix)
         connection = self._connection_dict.pop(prefix)
         self.freeInterface(connection.iface)
         connection.close()
         if self._gateway_manager is not None:
-            for ip in connection:
-                self._gateway_manager.remove(ip)
+            # In a batch, errors are raised when it is committed,
+            # i.e. not where MultiGatewayManager.remove ignores them.
+            try:
+                with self._netlink:
+                    for ip in connection:
+                        self._gateway_manager.remove(ip)
+            except netlink.NetlinkError, e:
+                logging.warning('Failed to delete gateway routes (%s)', e)
         logging.trace('Connection with %u/%u killed',
-                      int(prefix, 2), len(prefix))
-
-    def _newTunnelScore(self, prefix):
-        return (prefix in self._neighbour_set) + random.random()
+                      prefix.value, len(prefix))
 
     def _makeTunnel(self, prefix, address):
         if prefix in self._served or prefix in self._connection_dict:
             return False
         assert prefix != self._prefix, self.__dict__
+        if not (self._free_iface_list or self.new_iface_list):
+            logging.info('No free interface for a tunnel to %u/%u',
+                         prefix.value, len(prefix))
+            return False
         address_list = []
         same_country  = self.cache.same_country
         for x in utils.parse_address(address):
@@ -878,19 +1265,20 @@ class TunnelManager(BaseTunnelManager):
         if not address_list:
             return False
         logging.info('Establishing a connection with %u/%u',
-                     int(prefix, 2), len(prefix))
+                     prefix.value, len(prefix))
         with utils.exit:
             iface = self._getFreeInterface(prefix)
             self._connection_dict[prefix] = c = Connection(
                 self, address_list, iface, prefix)
         if self._gateway_manager is not None:
-            for ip in c:
-                self._gateway_manager.add(ip, True)
+            with self._netlink:
+                for ip in c:
+                    self._gateway_manager.add(ip, True)
         c.open()
         return True
 
     def _makeNewTunnels(self, route_dumped):
-        count = self._client_count - len(self._connection_dict)
+        count = max(0, self._client_count - len(self._connection_dict))
         if not count:
             return
         # CAVEAT: Forget any peer that didn't reply to our previous address
@@ -901,15 +1289,13 @@ class TunnelManager(BaseTunnelManager):
         distant_peers = self._distant_peers
         if route_dumped:
             logging.debug('Analyze routes ...')
-            neighbours = self.ctl.neighbours
-            # Collect all nodes known by Babel
-            peers = {prefix
-                for neigh_routes in neighbours.itervalues()
-                for prefix in neigh_routes[1]
-                if prefix}
+            # All nodes known by Babel
+            peers = self.ctl.routes
             # Keep only distant peers.
-            distant_peers[:] = peers.difference(neighbours)
-            distant_peers.sort(key=self._newTunnelScore)
+            neighbours = self.ctl.neighbours
+            distant_peers[:] = (prefix for prefix in peers
+                                if prefix not in neighbours)
+            distant_peers.sort(key=self._strategy.newTunnelScore)
             # Check whether we're connected to the network.
             registry = self.cache.registry_prefix
             if registry == self._prefix:
@@ -995,12 +1381,12 @@ class TunnelManager(BaseTunnelManager):
     def handleClientEvent(self):
         msg = self._read_sock.recv(65536)
         logging.debug("route_up%s", msg)
-        common_name, time, serial, ip = eval(msg)
-        prefix = utils.binFromSubnet(common_name)
+        common_name, time, serial, ip, iface = eval(msg)
+        prefix = utils.prefixFromSubnet(common_name)
         c = self._connection_dict.get(prefix)
-        if c and c.time < float(time):
+        if c and c.startTime(iface) < float(time):
             try:
-                c.connected(serial)
+                c.connected(iface, serial)
             except (KeyError, TypeError), e:
                 logging.error("%s (route_up %s)", e, common_name)
         else:
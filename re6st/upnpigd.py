@@ -44,8 +44,11 @@ class Forwarder(object):
                 raise UPnPException(str(e))
         return wraps(wrapped)(wrapper)
 
-    def select(self, r, w, t):
-        t.append((self.next_refresh, self.refresh))
+    def register(self, loop):
+        def refresh():
+            self.refresh()
+            loop.call_at(self.next_refresh, refresh)
+        loop.call_at(self.next_refresh, refresh)
 
     def checkExternalIp(self, ip=None):
         if not ip:
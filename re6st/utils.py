@@ -1,6 +1,10 @@
 import argparse, errno, fcntl, hashlib, logging, os, select as _select
 import shlex, signal, socket, sqlite3, struct, subprocess
 import sys, textwrap, threading, time, traceback
+from collections import deque
+from heapq import heappop, heappush
+from operator import itemgetter
+from Queue import Queue
 
 # PY3: It will be even better to use Popen(pass_fds=...),
 #      and then socket.SOCK_CLOEXEC will be useless.
@@ -185,10 +189,140 @@ class Popen(subprocess.Popen):
             return r
 
 
+class Supervisor(object):
+    """Restart subprocesses that exit unexpectedly
+
+    Exits are noticed as soon as SIGCHLD is received, because signals
+    wake up the main loop (see signal.set_wakeup_fd). Functions in
+    'callbacks' are also called then, for other children.
+    """
+
+    _loop = None
+
+    def __init__(self):
+        self._processes = []
+        self.callbacks = []
+
+    def register(self, loop):
+        self._loop = loop
+        self._r, self._w = r, w = pipe()
+        signal.set_wakeup_fd(w)
+        signal.signal(signal.SIGCHLD, lambda *args: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        loop.register(r, self._wakeup)
+        self._check()
+
+    def close(self):
+        if self._loop:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+            self._loop.unregister(self._r)
+            os.close(self._r)
+            os.close(self._w)
+            del self._loop
+
+    def _wakeup(self):
+        try:
+            os.read(self._r, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self._check()
+
+    def _check(self):
+        # Only poll our processes: waiting for any child would steal
+        # the exit status of other subprocesses.
+        for p in self._processes[:]:
+            p._check()
+        for callback in self.callbacks:
+            callback()
+
+
+class ManagedProcess(object):
+    """Subprocess restarted by a Supervisor, with exponential backoff
+
+    'start' returns a new Popen instance and 'restarted', if any, is
+    called after each restart.
+    """
+
+    restarts = 0
+    _failures = 0
+    _timer = None
+
+    def __init__(self, supervisor, name, start, restarted=None):
+        self.name = name
+        self._supervisor = supervisor
+        self._start = start
+        self._restarted = restarted
+        self.process = start()
+        self.started = time.time()
+        supervisor._processes.append(self)
+
+    @property
+    def alive(self):
+        return self.process.returncode is None
+
+    def _check(self):
+        if self._timer or self.process.poll() is None:
+            return
+        self._scheduleRestart("%s exited with status %s."
+                              % (self.name, self.process.returncode))
+
+    def _scheduleRestart(self, msg):
+        now = time.time()
+        # Reset backoff if the process ran long enough.
+        self._failures = 0 if self.started + 60 < now else self._failures + 1
+        delay = min(60, (1 << self._failures) - 1)
+        logging.error("%s Restarting in %us...", msg, delay)
+        self._timer = self._supervisor._loop.call_at(now + delay,
+                                                     self._restart)
+
+    def restart(self):
+        """Stop the process and start a new one immediately
+
+        This is how new parameters are applied, since 'start' is called again.
+        """
+        if self._timer:
+            self._timer.cancel()
+        else:
+            self.process.stop()
+        self._restart()
+
+    def _restart(self):
+        self.__dict__.pop('_timer', None)
+        self.restarts += 1
+        # Set before starting, so that failures to start count for backoff.
+        self.started = time.time()
+        try:
+            self.process = self._start()
+        except Exception, e:
+            self._scheduleRestart("Failed to restart %s (%s)." % (self.name, e))
+            return
+        if self._restarted:
+            self._restarted()
+        self._check() # in case it failed to start
+
+    def stop(self):
+        self._supervisor._processes.remove(self)
+        if self._timer:
+            self._timer.cancel()
+            del self._timer
+        return self.process.stop()
+
+
 def setCloexec(fd):
     flags = fcntl.fcntl(fd, fcntl.F_GETFD)
     fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
 
+def pipe():
+    """Non-blocking pipe, to wake up the main loop"""
+    r, w = os.pipe()
+    for fd in r, w:
+        setCloexec(fd)
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return r, w
+
 def select(R, W, T):
     try:
         r, w, _ = _select.select(R, W, (),
@@ -206,6 +340,186 @@ def select(R, W, T):
         if next_refresh <= t:
             refresh()
 
+class WorkerPool(object):
+    """Threads to run slow functions outside the main loop
+
+    The callback given to submit() is called from the main loop, with a
+    function that returns the result or reraises the exception.
+    """
+
+    def __init__(self, size=2):
+        self._queue = Queue()
+        self._done = deque()
+        self._r, self._w = pipe()
+        self._threads = []
+        for x in xrange(size):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def close(self):
+        # Workers must be stopped before closing the pipe: otherwise, they
+        # could write to another file that would reuse the descriptor.
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        os.close(self._r)
+        os.close(self._w)
+
+    def submit(self, callback, func, *args):
+        self._queue.put((callback, func, args))
+
+    def _run(self):
+        get = self._queue.get
+        while True:
+            x = get()
+            if x is None:
+                break
+            callback, func, args = x
+            try:
+                result = lambda x=func(*args): x
+            except Exception:
+                def result(exc_info=sys.exc_info()):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            self._done.append((callback, result))
+            try:
+                os.write(self._w, '\0')
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def register(self, loop):
+        loop.register(self._r, self._dispatch)
+
+    def _dispatch(self):
+        try:
+            os.read(self._r, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        done = self._done
+        while done:
+            callback, result = done.popleft()
+            callback(result)
+
+
+class Timer(object):
+
+    __slots__ = 'when', 'callback'
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.callback = None
+
+
+class EventLoop(object):
+    """Main loop based on epoll
+
+    Contrary to select(), file descriptors are registered once, with their
+    callbacks, and timers are kept in a heap. Each timer is called at most
+    once: a periodic task must schedule itself again.
+    """
+
+    def __init__(self):
+        self._epoll = _select.epoll()
+        setCloexec(self._epoll.fileno())
+        self._fd_dict = {}
+        self._timers = []
+
+    def close(self):
+        self._epoll.close()
+
+    def register(self, fd, reader=None, writer=None):
+        """Set callbacks of given socket or file descriptor
+
+        Unregister it if both callbacks are None.
+        """
+        if not isinstance(fd, (int, long)):
+            fd = fd.fileno()
+        mask = (_select.EPOLLIN if reader else 0) | (
+                _select.EPOLLOUT if writer else 0)
+        if not mask:
+            return self.unregister(fd)
+        if fd in self._fd_dict:
+            try:
+                self._epoll.modify(fd, mask)
+            except IOError, e:
+                # The previous file with this number was closed
+                # without being unregistered.
+                if e.errno != errno.ENOENT:
+                    raise
+                self._epoll.register(fd, mask)
+        else:
+            self._epoll.register(fd, mask)
+        self._fd_dict[fd] = reader, writer
+
+    def unregister(self, fd):
+        if not isinstance(fd, (int, long)):
+            fd = fd.fileno()
+        if self._fd_dict.pop(fd, None):
+            try:
+                self._epoll.unregister(fd)
+            except IOError, e:
+                if e.errno not in (errno.EBADF, errno.ENOENT):
+                    raise
+
+    def call_at(self, when, callback):
+        timer = Timer(when, callback)
+        heappush(self._timers, timer)
+        return timer
+
+    def run_once(self):
+        timers = self._timers
+        while timers and timers[0].callback is None:
+            heappop(timers)
+        try:
+            event_list = self._epoll.poll(
+                max(0, timers[0].when - time.time()) if timers else -1)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            return
+        fd_dict = self._fd_dict
+        for fd, event in event_list:
+            if event & (_select.EPOLLIN | _select.EPOLLERR |
+                        _select.EPOLLHUP):
+                try:
+                    reader = fd_dict[fd][0]
+                except KeyError:
+                    continue
+                if reader:
+                    reader()
+            if event & (_select.EPOLLOUT | _select.EPOLLERR |
+                        _select.EPOLLHUP):
+                try:
+                    writer = fd_dict[fd][1]
+                except KeyError:
+                    continue
+                if writer:
+                    writer()
+        # Callbacks of due timers may schedule new timers,
+        # which must not be run before the next iteration.
+        t = time.time()
+        due = []
+        while timers and timers[0].when <= t:
+            timer = heappop(timers)
+            if timer.callback:
+                due.append(timer)
+        for timer in due:
+            callback = timer.callback
+            if callback:
+                timer.callback = None
+                callback()
+
+
 def makedirs(*args):
     try:
         os.makedirs(*args)
@@ -213,22 +527,94 @@ def makedirs(*args):
         if e.errno != errno.EEXIST:
             raise
 
-def binFromIp(ip):
-    return binFromRawIp(socket.inet_pton(socket.AF_INET6, ip))
+class Prefix(tuple):
+    """Prefix of an IPv6 address, as an integer value and a number of bits
 
-def binFromRawIp(ip):
-    ip1, ip2 = struct.unpack('>QQ', ip)
-    return bin(ip1)[2:].rjust(64, '0') + bin(ip2)[2:].rjust(64, '0')
+    This is how prefixes are handled in memory. Strings of '0' and '1' are
+    only used in databases and in messages between nodes.
+    len() returns the number of bits and '%u/%u' % prefix formats it like the
+    CN of a certificate.
+    """
+    __slots__ = ()
+
+    def __new__(cls, value, length):
+        return tuple.__new__(cls, (value, length))
 
+    value = property(itemgetter(0))
+
+    def __len__(self):
+        return self[1]
+
+    def __str__(self):
+        value, length = self
+        return format(value, '0%ub' % length) if length else ''
+
+    def __repr__(self):
+        return 'Prefix(%u, %u)' % self
+
+    def __add__(self, other):
+        return Prefix(self[0] << other[1] | other[0], self[1] + other[1])
+
+    def startswith(self, other):
+        n = self[1] - other[1]
+        return n >= 0 and self[0] >> n == other[0]
+
+    # Same order as strings of bits.
+    def _key(self):
+        value, length = self
+        return value << 128 - length, length
+
+    def __lt__(self, other):
+        if isinstance(other, Prefix):
+            return self._key() < other._key()
+        return NotImplemented
+
+    def __le__(self, other):
+        if isinstance(other, Prefix):
+            return self._key() <= other._key()
+        return NotImplemented
+
+    def __gt__(self, other):
+        if isinstance(other, Prefix):
+            return self._key() > other._key()
+        return NotImplemented
+
+    def __ge__(self, other):
+        if isinstance(other, Prefix):
+            return self._key() >= other._key()
+        return NotImplemented
+
+def prefixFromBin(prefix):
+    return Prefix(int(prefix, 2), len(prefix))
+
+def prefixFromSubnet(subnet):
+    p, l = subnet.split('/')
+    p = Prefix(int(p), int(l))
+    if p[0] >> p[1] or not 0 <= p[1] <= 128:
+        raise ValueError("invalid subnet: %r" % subnet)
+    return p
+
+def prefixFromIp(ip):
+    return Prefix(intFromRawIp(socket.inet_pton(socket.AF_INET6, ip)), 128)
+
+def prefixFromIntIp(ip, start, end):
+    """Bits [start:end] of an IPv6 address given as an integer"""
+    n = end - start
+    if n <= 0:
+        return Prefix(0, 0)
+    return Prefix(ip >> 128 - end & (1 << n) - 1, n)
+
+def intFromRawIp(ip):
+    ip1, ip2 = struct.unpack('>QQ', ip)
+    return ip1 << 64 | ip2
 
-def ipFromBin(ip, suffix=''):
-    suffix_len = 128 - len(ip)
-    if suffix_len > 0:
-        ip += suffix.rjust(suffix_len, '0')
-    elif suffix_len:
+def ipFromPrefix(prefix, suffix=0):
+    suffix_len = 128 - len(prefix)
+    if suffix_len < 0:
         sys.exit("Prefix exceeds 128 bits")
+    ip = prefix[0] << suffix_len | suffix
     return socket.inet_ntop(socket.AF_INET6,
-        struct.pack('>QQ', int(ip[:64], 2), int(ip[64:], 2)))
+        struct.pack('>QQ', ip >> 64, ip & 0xffffffffffffffff))
 
 def dump_address(address):
     return ';'.join(map(','.join, address))
@@ -245,7 +631,7 @@ def parse_address(address_list):
 
 def binFromSubnet(subnet):
     p, l = subnet.split('/')
-    return bin(int(p))[2:].rjust(int(l), '0')
+    return format(int(p), '0%sb' % l)
 
 def newHmacSecret():
     from random import getrandbits as g
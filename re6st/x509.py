@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
-import calendar, hashlib, hmac, logging, os, struct, subprocess, threading, time
+import bisect, calendar, hashlib, hmac, logging, os, struct, subprocess
+import threading, time
+from collections import OrderedDict
+from datetime import datetime
 from OpenSSL import crypto
 from . import utils
 
@@ -7,7 +10,10 @@ def newHmacSecret():
     return utils.newHmacSecret(int(time.time() * 1000000))
 
 def networkFromCa(ca):
-    return bin(ca.get_serial_number())[3:]
+    # The serial of the CA is the network prefix, after a leading 1 bit.
+    serial = ca.get_serial_number()
+    n = serial.bit_length() - 1
+    return utils.Prefix(serial & (1 << n) - 1, n)
 
 def subnetFromCert(cert):
     return cert.get_subject().CN
@@ -18,13 +24,23 @@ def notBefore(cert):
 def notAfter(cert):
     return calendar.timegm(time.strptime(cert.get_notAfter(),'%Y%m%d%H%M%SZ'))
 
+def serialRanges(serials):
+    """Sorted serials -> [[first, last], ...]"""
+    ranges = []
+    for x in serials:
+        if ranges and ranges[-1][1] + 1 == x:
+            ranges[-1][1] = x
+        else:
+            ranges.append([x, x])
+    return ranges
+
 def openssl(*args):
     return utils.Popen(('openssl',) + args,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE)
 
-def encrypt(cert, data):
+def _encryptOpenssl(cert, data):
     r, w = os.pipe()
     try:
         threading.Thread(target=os.write, args=(w, cert)).start()
@@ -38,6 +54,40 @@ def encrypt(cert, data):
         raise subprocess.CalledProcessError(p.returncode, 'openssl', err)
     return out
 
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+    from cryptography.hazmat.primitives.serialization import \
+        load_pem_private_key
+    from cryptography.x509 import load_pem_x509_certificate
+except ImportError: # BBB: pyOpenSSL < 0.14 does not depend on cryptography
+
+  encrypt = _encryptOpenssl
+  load_pem_private_key = None
+
+else:
+
+  # Same output format as 'openssl rsautl' (PKCS#1 v1.5 padding).
+  def encrypt(cert, data):
+    return load_pem_x509_certificate(cert, default_backend()
+        ).public_key().encrypt(data, PKCS1v15())
+
+def _verify(ca, cert, attime):
+    # Same as 'openssl verify -CAfile <ca> [-attime <attime>]',
+    # without forking a process for each certificate.
+    store = crypto.X509Store()
+    store.add_cert(ca)
+    if attime is not None:
+        store.set_time(datetime.utcfromtimestamp(attime))
+    try:
+        crypto.X509StoreContext(store, cert).verify_certificate()
+    except crypto.X509StoreContextError, e:
+        # BBB: pyOpenSSL < 23.1 does not have 'errors'.
+        code, depth, msg = getattr(e, 'errors', None) or e.args[0]
+        raise VerifyError(code, depth, msg)
+if not hasattr(crypto.X509Store, 'set_time'): # BBB: pyOpenSSL < 17.0
+    _verify = None
+
 def fingerprint(cert, alg='sha1'):
     return hashlib.new(alg, crypto.dump_certificate(crypto.FILETYPE_ASN1, cert))
 
@@ -76,6 +126,21 @@ def maybe_renew(path, cert, info, renew, force=False):
     return cert, time.time() + 86400
 
 
+class Crl(object):
+    """Revoked serials, stored as sorted ranges"""
+
+    def __init__(self, ranges=()):
+        self._first = [x for x, _ in ranges]
+        self._last = [x for _, x in ranges]
+
+    def __contains__(self, serial):
+        i = bisect.bisect(self._first, serial)
+        return bool(i) and serial <= self._last[i-1]
+
+    def isdisjoint(self, serials):
+        return not any(x in self for x in serials)
+
+
 class VerifyError(Exception):
     pass
 
@@ -83,6 +148,53 @@ class NewSessionError(Exception):
     pass
 
 
+class VerifiedCache(object):
+    """LRU of certificates that passed strict verification
+
+    Peers resend the same certificate with each hello0, so verifying it again
+    is useless as long as it has not expired, and the CA and CRL are unchanged.
+    Entries are keyed by the SHA-1 of the DER certificate (the fingerprint
+    that is already used in hello0 packets) and contain:
+      (cert, notAfter, serial, subnet)
+    """
+
+    hits = misses = 0
+
+    def __init__(self, size=256):
+        self._size = size
+        self._lru = OrderedDict()
+
+    def __len__(self):
+        return len(self._lru)
+
+    def clear(self):
+        logging.debug("Clearing cache of %u verified certificates"
+                      " (%u hits, %u misses)",
+                      len(self._lru), self.hits, self.misses)
+        self._lru.clear()
+
+    def get(self, der):
+        key = hashlib.sha1(der).digest()
+        try:
+            entry = self._lru.pop(key)
+        except KeyError:
+            pass
+        else:
+            if time.time() < entry[1]:
+                self._lru[key] = entry
+                self.hits += 1
+                return entry
+        self.misses += 1
+
+    def add(self, der, cert):
+        lru = self._lru
+        lru[hashlib.sha1(der).digest()] = entry = (cert, notAfter(cert),
+            cert.get_serial_number(), subnetFromCert(cert))
+        if len(lru) > self._size:
+            lru.popitem(False)
+        return entry
+
+
 class Cert(object):
 
     def __init__(self, ca, key, cert=None):
@@ -92,14 +204,18 @@ class Cert(object):
         with open(ca) as f:
             self.ca = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
         with open(key) as f:
-            self.key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+            key = f.read()
+        self.key = crypto.load_privatekey(crypto.FILETYPE_PEM, key)
+        if load_pem_private_key:
+            self._rsa_key = load_pem_private_key(key, None, default_backend())
+        self.verified = VerifiedCache()
         if cert:
             with open(cert) as f:
                 self.cert = self.loadVerify(f.read())
 
     @property
     def prefix(self):
-        return utils.binFromSubnet(subnetFromCert(self.cert))
+        return utils.prefixFromSubnet(subnetFromCert(self.cert))
 
     @property
     def network(self):
@@ -117,10 +233,14 @@ class Cert(object):
 
     def maybeRenew(self, registry, crl):
         self.cert, next_renew = maybe_renew(self.cert_path, self.cert,
-              "Certificate", lambda: registry.renewCertificate(self.prefix),
+              "Certificate",
+              lambda: registry.renewCertificate(str(self.prefix)),
               self.cert.get_serial_number() in crl)
-        self.ca, ca_renew = maybe_renew(self.ca_path, self.ca,
+        ca = self.ca
+        self.ca, ca_renew = maybe_renew(self.ca_path, ca,
               "CA Certificate", registry.getCa)
+        if self.ca is not ca:
+            self.verified.clear()
         return min(next_renew, ca_renew)
 
     def loadVerify(self, cert, strict=False, type=crypto.FILETYPE_PEM):
@@ -128,12 +248,20 @@ class Cert(object):
             r = crypto.load_certificate(type, cert)
         except crypto.Error:
             raise VerifyError(None, None, 'unable to load certificate')
-        if type != crypto.FILETYPE_PEM:
-            cert = crypto.dump_certificate(crypto.FILETYPE_PEM, r)
+        attime = None if strict else min(int(time.time()),
+            max(notBefore(self.ca), notBefore(r)))
+        if _verify is None: # BBB: pyOpenSSL < 17.0
+            if type != crypto.FILETYPE_PEM:
+                cert = crypto.dump_certificate(crypto.FILETYPE_PEM, r)
+            self._verifyOpenssl(cert, attime)
+        else:
+            _verify(self.ca, r, attime)
+        return r
+
+    def _verifyOpenssl(self, cert, attime):
         args = ['verify', '-CAfile', self.ca_path]
-        if not strict:
-            args += '-attime', str(min(int(time.time()),
-                max(notBefore(self.ca), notBefore(r))))
+        if attime is not None:
+            args += '-attime', str(attime)
         p = openssl(*args)
         out, err = p.communicate(cert)
         if 1: # BBB: Old OpenSSL could return 0 in case of errors.
@@ -148,7 +276,6 @@ class Cert(object):
                     x, msg = x.split(':', 1)
                     _, code, _, depth, _ = x.split(None, 4)
                     raise VerifyError(int(code), int(depth), msg.strip())
-        return r
 
     def verify(self, sign, data):
         crypto.verify(self.ca, sign, data, 'sha512')
@@ -157,6 +284,8 @@ class Cert(object):
         return crypto.sign(self.key, data, 'sha512')
 
     def decrypt(self, data):
+        if load_pem_private_key:
+            return self._rsa_key.decrypt(data, PKCS1v15())
         p = openssl('rsautl', '-decrypt', '-inkey', self.key_path)
         out, err = p.communicate(data)
         if p.returncode:
@@ -218,9 +347,11 @@ class Peer(object):
     __eq__ = __ge__ = __le__ = __ne__
 
     def __gt__(self, other):
-        return self.prefix > (other if type(other) is str else other.prefix)
+        return self.prefix > (other if type(other) is utils.Prefix
+                              else other.prefix)
     def __lt__(self, other):
-        return self.prefix < (other if type(other) is str else other.prefix)
+        return self.prefix < (other if type(other) is utils.Prefix
+                              else other.prefix)
 
     def hello0(self, cert):
         if self._hello < time.time():
@@ -233,13 +364,20 @@ class Peer(object):
     def hello0Sent(self):
         self._hello = time.time() + 60
 
-    def hello(self, cert):
-        key = self._key = newHmacSecret()
-        h = encrypt(crypto.dump_certificate(crypto.FILETYPE_PEM, self.cert),
+    @staticmethod
+    def newSessionKey(cert, peer_cert):
+        # Slow part of hello(), which does not change the state of the peer
+        # and can be done in another thread.
+        key = newHmacSecret()
+        h = encrypt(crypto.dump_certificate(crypto.FILETYPE_PEM, peer_cert),
                     key)
+        return key, h + cert.sign(h)
+
+    def hello(self, key, msg):
+        self._key = key
         self._i = self._j = 2
         self._last = 0
-        return '\0\0\0\2' + h + cert.sign(h)
+        return '\0\0\0\2' + msg
 
     def _hmac(self, msg):
         return hmac.HMAC(self._key, msg, hashlib.sha1).digest()
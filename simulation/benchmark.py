@@ -0,0 +1,225 @@
+#!/usr/bin/env python2
+"""Microbenchmarks of re6st hot paths
+
+Each command compares the current implementation with the one it
+replaced, and prints the number of operations per second.
+
+Usage (from a checkout): simulation/benchmark.py --help
+"""
+import argparse, os, shutil, struct, sys, tempfile, time
+sys.path[0] = os.path.dirname(sys.path[0])
+sys.dont_write_bytecode = True
+from OpenSSL import crypto
+from re6st import ctl, utils, x509
+
+
+def rate(func, duration):
+    """Call 'func' repeatedly during about 'duration' seconds
+
+    Return the number of calls per second.
+    """
+    n = 0
+    t = time.time()
+    end = t + duration
+    while True:
+        func()
+        n += 1
+        x = time.time()
+        if end < x:
+            return n / (x - t)
+
+def compare(duration, *args):
+    """Print the rate of each (name, func) in 'args', relative to the first"""
+    ref = None
+    for name, func in args:
+        x = rate(func, duration)
+        if ref is None:
+            ref = x
+        print '%-28s %10.1f/s %8.2fx' % (name, x, x / ref)
+
+
+class TestCertificates(object):
+    """Temporary CA and node certificate, like the registry creates"""
+
+    def __init__(self, bits):
+        self.path = tempfile.mkdtemp()
+        ca_key = self._newKey(bits)
+        self.ca = self._newCert(ca_key, ca_key, 1, 'CA')
+        self.key = self._newKey(bits)
+        self.cert = self._newCert(self.key, ca_key, 2, '1/16', self.ca)
+        self.ca_path = self._write('ca.crt', crypto.FILETYPE_PEM, self.ca)
+        self.key_path = os.path.join(self.path, 'cert.key')
+        with open(self.key_path, 'w') as f:
+            f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, self.key))
+        self.cert_path = self._write('cert.crt', crypto.FILETYPE_PEM,
+                                     self.cert)
+
+    def close(self):
+        shutil.rmtree(self.path)
+
+    @staticmethod
+    def _newKey(bits):
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, bits)
+        return key
+
+    @staticmethod
+    def _newCert(key, ca_key, serial, cn, ca=None):
+        cert = crypto.X509()
+        cert.set_serial_number(serial)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(86400)
+        cert.get_subject().CN = cn
+        cert.set_issuer((ca or cert).get_subject())
+        cert.set_pubkey(key)
+        cert.sign(ca_key, 'sha512')
+        return cert
+
+    def _write(self, name, type, cert):
+        path = os.path.join(self.path, name)
+        with open(path, 'w') as f:
+            f.write(crypto.dump_certificate(type, cert))
+        return path
+
+
+def verify(config):
+    """Verification of peer certificates (x509.Cert.loadVerify)"""
+    certs = TestCertificates(config.bits)
+    try:
+        cert = x509.Cert(certs.ca_path, certs.key_path)
+        der = crypto.dump_certificate(crypto.FILETYPE_ASN1, certs.cert)
+        def verify():
+            cert.loadVerify(der, True, crypto.FILETYPE_ASN1)
+        def subprocess():
+            x = x509._verify
+            x509._verify = None
+            try:
+                verify()
+            finally:
+                x509._verify = x
+        compare(config.duration,
+            ("openssl verify", subprocess),
+            ("in-process", verify))
+    finally:
+        certs.close()
+
+
+def rsa(config):
+    """RSA encryption & decryption of session keys (x509.encrypt/decrypt)"""
+    certs = TestCertificates(config.bits)
+    try:
+        cert = x509.Cert(certs.ca_path, certs.key_path)
+        pem = crypto.dump_certificate(crypto.FILETYPE_PEM, certs.cert)
+        key = x509.newHmacSecret()
+        data = x509.encrypt(pem, key)
+        assert cert.decrypt(x509._encryptOpenssl(pem, key)) == key
+        compare(config.duration,
+            ("openssl rsautl -encrypt",
+             lambda: x509._encryptOpenssl(pem, key)),
+            ("in-process encrypt", lambda: x509.encrypt(pem, key)))
+        def decrypt():
+            assert cert.decrypt(data) == key
+        def subprocess():
+            x = x509.load_pem_private_key
+            x509.load_pem_private_key = None
+            try:
+                decrypt()
+            finally:
+                x509.load_pem_private_key = x
+        compare(config.duration,
+            ("openssl rsautl -decrypt", subprocess),
+            ("in-process decrypt", decrypt))
+    finally:
+        certs.close()
+
+
+def dump(config):
+    """Decoding of a babeld dump (ctl.Babel.handle_dump)"""
+    # The control protocol encodes the number of items of an array on
+    # 16 bits, which limits the size of a dump.
+    n = min(config.routes, 0xffff)
+    print 'routes: %u' % n
+    # 2001:db8::/32 network with 16-bit node prefixes, and as many IPv4
+    # routes (e.g. with the 'ipv4' network parameter) as IPv6 ones.
+    network = utils.Prefix(0x20010db8, 32)
+    neighbours = [struct.pack('!QQ', 0xfe80 << 48, i) for i in xrange(8)]
+    data = ctl.Buffer()
+    data += struct.pack('!H', 1)
+    ctl.Struct("I").encode(data, (1,))
+    ctl.String.encode(data, 're6stnet1')
+    data += struct.pack('!H', len(neighbours))
+    for address in neighbours:
+        data += struct.pack("!16sIHHHHHiHH", address, 1, 0xffff,
+                            256, 256, 10, 0, 0, 1, 256)
+    data += struct.pack('!HH', 0, n)
+    route = struct.Struct("!16sBHHH8siiI16s16sB")
+    for i in xrange(n):
+        nexthop = neighbours[i // 2 % len(neighbours)]
+        if i % 2:
+            # The first routes are the ones to the neighbours.
+            prefix = struct.pack('!IHQH', 0x20010db8, i // 2, 0, 0)
+            data += route.pack(prefix, 48, 256, 256,
+                               256 * (i // 2 >= len(neighbours)), '',
+                               0, 0, 1, nexthop, nexthop, 1)
+        else:
+            prefix = struct.pack('!Q2H4s', 0, 0, 0xffff,
+                                 struct.pack('!I', i))
+            data += route.pack(prefix, 128, 256, 256, 256, '',
+                               0, 0, 1, nexthop, nexthop, 1)
+    data = data._buf
+    decode = ctl.Packet.response_dict[1] # Dump
+    ipv4 = ctl.IPV4_MAPPED
+    def lazy():
+        for route in decode(data)[1].routes.iterexcept(ipv4):
+            pass
+    # Like before lazy decoding: 1 namedtuple per record of any array.
+    def eagerArrayDecode(self, buffer, offset=0):
+        r = []
+        o = offset + 2
+        decode = self._item.decode
+        for i in xrange(*ctl.uint16.unpack_from(buffer, offset)):
+            o, x = decode(buffer, o)
+            r.append(x)
+        return o, r
+    def eager():
+        lazy_decode = ctl.Array.decode
+        ctl.Array.decode = eagerArrayDecode
+        try:
+            for route in decode(data)[1].routes:
+                if route.prefix.startswith(ipv4):
+                    continue
+        finally:
+            ctl.Array.decode = lazy_decode
+    class Handler(object):
+        def babel_dump(self):
+            pass
+    babel = ctl.Babel(os.devnull, Handler(), network)
+    def handle_dump():
+        babel.handle_dump(*decode(data)[1])
+    compare(config.duration,
+        ("eager decode", eager),
+        ("lazy decode", lazy),
+        ("lazy decode + handle_dump", handle_dump))
+    babel.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the speed of re6st hot paths.")
+    _ = parser.add_argument
+    _('-t', '--duration', type=float, default=3,
+        help="Time, in seconds, to measure each implementation.")
+    _('--bits', type=int, default=2048,
+        help="Size of RSA keys.")
+    _('--routes', type=int, default=100000,
+        help="Number of routes in the dump (at most 65535).")
+    _('command', choices=('verify', 'rsa', 'dump'), nargs='+')
+    config = parser.parse_args()
+    utils.setupLog(1)
+    for command in config.command:
+        func = globals()[command]
+        print '# %s: %s' % (command, func.__doc__)
+        func(config)
+
+if __name__ == '__main__':
+    main()
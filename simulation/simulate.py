@@ -0,0 +1,547 @@
+#!/usr/bin/env python2
+"""Discrete-event simulation of tunnel selection
+
+Contrary to the C++ simulator, which reimplements the overlay logic, this
+one drives the real TunnelManager code (_makeNewTunnels, _removeSomeTunnels,
+Connection, TunnelKiller, tunnel strategies, etc). What is replaced:
+- babeld, by a route oracle computing shortest paths on the overlay graph,
+- OpenVPN clients & servers, by fake processes that connect after a delay
+  depending on the latency between the 2 nodes, or fail if the address
+  is dead,
+- the registry and the cache of peers,
+- time, by a virtual clock, so that hours are simulated in minutes,
+- the UDP side channel between nodes, by direct method calls.
+
+Nodes are placed randomly in a square and the one-way latency between 2
+nodes is proportional to their distance. The path stretch is the ratio
+between the latency of the path chosen by the routing protocol and the
+direct latency.
+
+Each request for a dump computes shortest paths from the requesting node,
+so the cost grows quickly with the number of nodes. Use pypy for large
+networks.
+
+Usage (from a checkout): simulation/simulate.py --help
+"""
+import argparse, os, random, socket, struct, sys
+from collections import defaultdict, deque, namedtuple
+from heapq import heappop, heappush
+sys.path[0] = os.path.dirname(sys.path[0])
+sys.dont_write_bytecode = True
+from re6st import tunnel, utils
+
+PREFIX_LEN = 16
+# Time for an OpenVPN client to give up with a dead address.
+CONNECT_TIMEOUT = 60
+SERVER_IFACE = 're6stnet-udp'
+SERVER_IFINDEX = 1000
+
+Neighbour = namedtuple('neighbour', 'address ifindex rtt cost_multiplier')
+Route = namedtuple('route', 'metric ifindex nexthop')
+
+def address(prefix):
+    # Link-local address of a node.
+    return struct.pack('!QQ', 0xfe80 << 48, prefix.value)
+
+def rttcost(rtt):
+    # Same as babeld with the default options of the registry
+    # ('max-rtt-penalty 5000 rtt-max 500') and rtt-min 10.
+    if rtt <= 10:
+        return 0
+    return min(5000, 5000 * (rtt - 10) // 490)
+
+
+class Clock(object):
+
+    # Like time.time(), the clock must not start at 0, which is a special
+    # value in TunnelManager.
+    start = now = 1e9
+
+    def time(self):
+        return self.now
+
+
+class Link(object):
+
+    def __init__(self, client, server, iface, latency):
+        self.client = client._prefix
+        self.server = server._prefix
+        self.ifindex = {self.client: int(iface[8:]),
+                        self.server: SERVER_IFINDEX}
+        self.latency = latency
+        self.rtt = int(2000 * latency)
+        self.multiplier = {}
+        self.setMultiplier(self.client, 256)
+        self.setMultiplier(self.server, 256)
+
+    def peer(self, prefix):
+        return self.server if prefix == self.client else self.client
+
+    def setMultiplier(self, prefix, value):
+        m = self.multiplier
+        m[prefix] = value
+        # None if any side does not want to route through this link.
+        self.cost = (256 + rttcost(self.rtt)) * max(m.itervalues()) // 256 \
+            if len(m) == 2 and all(m.itervalues()) else None
+
+
+class Babel(object):
+    """Route oracle, with the same interface as ctl.Babel"""
+
+    def __init__(self, sim, tunnel_manager):
+        self.sim = sim
+        self.tm = tunnel_manager
+        self.neighbours = {}
+        self.routes = {}
+        self.locked = set()
+        self.interfaces = {SERVER_IFINDEX: SERVER_IFACE}
+
+    def reset(self):
+        pass
+
+    close = reset
+
+    def request_dump(self):
+        me = self.tm._prefix
+        keys = {}
+        interfaces = self.interfaces = {SERVER_IFINDEX: SERVER_IFACE}
+        for link in self.sim.links[me]:
+            ifindex = link.ifindex[me]
+            keys[link] = Neighbour(address(link.peer(me)), ifindex,
+                                   link.rtt, link.multiplier[me])
+            if ifindex != SERVER_IFINDEX:
+                interfaces[ifindex] = 're6stnet%u' % ifindex
+        routes = self.routes = {}
+        via = defaultdict(dict)
+        for dst, (metric, latency, first) in \
+                self.sim.shortestPaths(me).iteritems():
+            if first:
+                n = keys[first]
+                via[first][dst] = routes[dst] = Route(metric, n.ifindex,
+                                                      n.address)
+        neighbours = self.neighbours = {}
+        locked = self.locked = set()
+        unidentified = {}
+        for link, n in keys.iteritems():
+            peer = link.peer(me)
+            r = via[link]
+            if peer in r and r[peer].metric == link.cost:
+                neighbours[peer] = n, r
+            else:
+                if not n.cost_multiplier:
+                    locked.add((n.address, n.ifindex))
+                unidentified.update(r)
+        if unidentified:
+            neighbours[None] = None, unidentified
+        self.tm.babel_dump()
+
+    def send(self, packet):
+        # Only SetCostMultiplier is sent by TunnelManager.
+        neigh_address, ifindex, value = packet.args
+        me = self.tm._prefix
+        for link in self.sim.links[me]:
+            if (link.ifindex[me] == ifindex and
+                address(link.peer(me)) == neigh_address):
+                link.setMultiplier(me, value)
+                self.sim.changed()
+                break
+
+
+class Cache(object):
+
+    crl = ()
+    encrypt = False
+    same_country = None
+
+    def __init__(self, sim, prefix, config):
+        self.sim = sim
+        self._prefix = prefix
+        self._peers = {} # {prefix: [address, try]}
+        self.client_count = config.client_count
+        self.registry_prefix = sim.registry
+        self.tunnel_refresh = config.tunnel_refresh
+
+    def log(self):
+        pass
+
+    def addPeer(self, prefix, address, set_preferred=False):
+        try:
+            self._peers[prefix][0] = address
+        except KeyError:
+            self._peers[prefix] = [address, 0]
+
+    def connecting(self, prefix, connecting):
+        try:
+            self._peers[prefix][1] = connecting
+        except KeyError:
+            pass
+
+    def getAddress(self, prefix):
+        try:
+            address, failed = self._peers[prefix]
+        except KeyError:
+            return
+        if not failed:
+            return address
+
+    def getPeerList(self, failed=0):
+        peer_list = [(prefix, address)
+            for prefix, (address, x) in self._peers.iteritems()
+            if x == failed and prefix != self._prefix]
+        random.shuffle(peer_list)
+        return peer_list
+
+    def getBootstrapPeer(self):
+        # Same as RegistryServer.getBootstrapPeer
+        sim = self.sim
+        registry = sim.nodes[sim.registry]
+        peer = random.choice(registry.ctl.routes.keys() + [sim.registry])
+        if peer == self._prefix:
+            peer = sim.registry
+        if peer != self._prefix:
+            address = sim.nodes[peer].address
+            self.addPeer(peer, address)
+            return peer, address
+
+
+class Client(object):
+    """OpenVPN client, with the same interface as utils.Popen
+
+    It connects after a delay depending on the latency between the 2 nodes,
+    or exits after CONNECT_TIMEOUT seconds if the address is dead.
+    """
+
+    returncode = _link = None
+
+    def __init__(self, connection, iface, address):
+        self._connection = connection
+        self._iface = iface
+        tm = connection.tunnel_manager
+        sim = tm.sim
+        now = sim.clock.now
+        self._start = now
+        if iface != connection.iface:
+            sim.races += 1
+        if ','.join(address) in sim.dead:
+            sim.call_at(now + CONNECT_TIMEOUT, self._exit)
+        else:
+            sim.call_at(now + 1 + 2 * sim.latency(tm._prefix,
+                connection._prefix), self._connect)
+
+    def poll(self):
+        return self.returncode
+
+    def _exit(self):
+        if self.returncode is None:
+            self.returncode = 1
+            self._connection.tunnel_manager.childExited()
+
+    def _connect(self):
+        if self.returncode is not None:
+            return
+        c = self._connection
+        tm = c.tunnel_manager
+        sim = tm.sim
+        server = sim.nodes.get(c._prefix)
+        if (server is None or sim.max_clients <= sum(
+                map(len, server._served.itervalues())) or
+            not server._ovpn_client_connect(sim.commonName(tm._prefix),
+                SERVER_IFACE, tm._prefix.value, None)):
+            return self._exit()
+        self._link = sim.link(tm, server, self._iface)
+        # Same as route-up notifications (TunnelManager.handleClientEvent).
+        if (tm._connection_dict.get(c._prefix) is c and
+            c.startTime(self._iface) <= self._start):
+            if self._iface != c.iface:
+                sim.races_won += 1
+            c.connected(self._iface, c._prefix.value)
+
+    def stop(self):
+        if self.returncode is None:
+            self.returncode = 0
+            link = self._link
+            if link:
+                tm = self._connection.tunnel_manager
+                sim = tm.sim
+                sim.unlink(link)
+                server = sim.nodes.get(self._connection._prefix)
+                if server:
+                    server._ovpn_client_disconnect(sim.commonName(tm._prefix),
+                        SERVER_IFACE, tm._prefix.value, None)
+
+
+class Connection(tunnel.Connection):
+    """tunnel.Connection with simulated OpenVPN clients"""
+
+    def _client(self, iface, address):
+        return Client(self, iface, address)
+
+
+class Node(tunnel.TunnelManager):
+    """TunnelManager without sockets, certificates, netlink & OpenVPN"""
+
+    def __init__(self, sim, prefix, config):
+        # Same initialization as BaseTunnelManager & TunnelManager,
+        # for what is used by tunnel selection.
+        self.sim = sim
+        self._prefix = prefix
+        # 2 addresses, the first one being dead for a fraction of nodes,
+        # so that alternate addresses are tried (in parallel if possible).
+        address = ['%s,%u,udp4' % (prefix, port) for port in (1194, 1195)]
+        if random.random() < config.dead_address:
+            sim.dead.add(address[0])
+        self.address = ';'.join(address)
+        self.cache = Cache(sim, prefix, config)
+        self.timeout = 4 * config.hello
+        self._loop = sim
+        self._timeouts = {}
+        self._connecting = set()
+        self._connection_dict = {}
+        self._served = defaultdict(dict)
+        self._address = {socket.AF_INET: self.address}
+        self.ctl = Babel(sim, self)
+        self._disconnected = 0
+        self._distant_peers = []
+        self._iface_to_prefix = {}
+        self._ip_changed = None
+        self._gateway_manager = None
+        self._disable_proto = ()
+        self._neighbour_set = set()
+        self._killing = {}
+        self._strategy = tunnel.tunnel_strategy_dict[config.strategy](self)
+        self.resetTunnelRefresh()
+        self._client_count = self._iface_count = config.client_count
+        self._auto_client_count = False
+        self.new_iface_list = deque()
+        self._free_iface_list = ['re6stnet%u' % i for i in xrange(
+            config.client_count + self.race_iface_count, 0, -1)]
+        self.selectTimeout(sim.clock.now, self.refresh)
+
+    def checkRoutingCache(self):
+        pass
+
+    def sendto(self, prefix, msg):
+        return self.sim.sendto(self, prefix, msg)
+
+
+class Simulator(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.clock = Clock()
+        self._timers = []
+        self.nodes = {}
+        self.links = defaultdict(list)
+        self.max_clients = config.max_clients or 2 * config.client_count
+        self._position = {}
+        self._paths = {}
+        self.created = self.removed = 0
+        self.races = self.races_won = 0
+        self.dead = set()
+        self.connected_since = None
+        self.registry = self.prefix(0)
+
+    # Event loop (same interface as utils.EventLoop)
+
+    def call_at(self, when, callback):
+        timer = utils.Timer(when, callback)
+        heappush(self._timers, timer)
+        return timer
+
+    def run(self, until):
+        """Process events until 'until' seconds after the start"""
+        timers = self._timers
+        clock = self.clock
+        until += clock.start
+        while timers and timers[0].when <= until:
+            timer = heappop(timers)
+            callback = timer.callback
+            if callback is not None:
+                clock.now = max(clock.now, timer.when)
+                callback()
+        clock.now = until
+
+    # Topology
+
+    @staticmethod
+    def prefix(i):
+        return utils.Prefix(i + 1, PREFIX_LEN)
+
+    @staticmethod
+    def commonName(prefix):
+        return '%u/%u' % prefix
+
+    def latency(self, a, b):
+        (xa, ya), (xb, yb) = self._position[a], self._position[b]
+        return self.config.max_latency * ((xa-xb)**2 + (ya-yb)**2) ** .5
+
+    def addNode(self, i):
+        prefix = self.prefix(i)
+        self._position[prefix] = random.random(), random.random()
+        self.nodes[prefix] = Node(self, prefix, self.config)
+
+    def changed(self):
+        self._paths.clear()
+
+    def link(self, client, server, iface):
+        link = Link(client, server, iface,
+                    self.latency(client._prefix, server._prefix))
+        self.links[link.client].append(link)
+        self.links[link.server].append(link)
+        self.created += 1
+        self.changed()
+        return link
+
+    def unlink(self, link):
+        self.links[link.client].remove(link)
+        self.links[link.server].remove(link)
+        self.removed += 1
+        self.changed()
+
+    def shortestPaths(self, source):
+        """{dst: (metric, latency, first link)} for routes from 'source'"""
+        try:
+            return self._paths[source]
+        except KeyError:
+            pass
+        links = self.links
+        paths = {}
+        best = {source: 0}
+        heap = [(0, 0, source, None)]
+        while heap:
+            metric, latency, prefix, first = heappop(heap)
+            if prefix in paths:
+                continue
+            paths[prefix] = metric, latency, first
+            for link in links[prefix]:
+                cost = link.cost
+                if cost:
+                    cost += metric
+                    peer = link.peer(prefix)
+                    if cost < best.get(peer, cost + 1):
+                        best[peer] = cost
+                        heappush(heap, (cost, latency + link.latency,
+                                        peer, first or link))
+        self._paths[source] = paths
+        return paths
+
+    def sendto(self, tm, prefix, msg):
+        if msg is None or prefix not in tm.ctl.routes:
+            return
+        try:
+            latency = self.shortestPaths(tm._prefix)[prefix][1]
+        except KeyError: # changed since last dump
+            return
+        def reply():
+            src = self.nodes.get(prefix)
+            if src:
+                answer = src._processPacket(msg, tm._prefix)
+                if answer:
+                    self.call_at(self.clock.now + latency,
+                        lambda: tm._processPacket(msg[0] + answer, prefix))
+        self.call_at(self.clock.now + latency, reply)
+        return True
+
+    # Statistics
+
+    def reachable(self):
+        links = self.links
+        seen = {self.registry}
+        todo = [self.registry]
+        while todo:
+            for link in links[todo.pop()]:
+                for peer in link.client, link.server:
+                    if peer not in seen:
+                        seen.add(peer)
+                        todo.append(peer)
+        return len(seen)
+
+    def stretch(self, samples):
+        nodes = self.nodes.keys()
+        total = n = 0
+        for i in xrange(samples):
+            a, b = random.sample(nodes, 2)
+            latency = self.latency(a, b)
+            try:
+                path = self.shortestPaths(a)[b][1]
+            except KeyError:
+                continue
+            if latency:
+                total += path / latency
+                n += 1
+        return total / n if n else float('nan')
+
+    def report(self, last):
+        now = self.clock.now
+        reachable = self.reachable()
+        if reachable == len(self.nodes) == self.config.nodes:
+            if self.connected_since is None:
+                self.connected_since = now - self.clock.start
+        else:
+            self.connected_since = None
+        tunnels = sum(map(len, self.links.itervalues())) // 2
+        created, removed = self.created, self.removed
+        print '%6u %6u %6u %8u %8.3f %8u %8u' % (
+            now - self.clock.start, len(self.nodes), reachable, tunnels,
+            self.stretch(self.config.samples),
+            created - last[0], removed - last[1])
+        return created, removed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate tunnel selection of re6st nodes.")
+    _ = parser.add_argument
+    _('-n', '--nodes', type=int, default=100,
+        help="Number of nodes, including the registry.")
+    _('-t', '--duration', type=int, default=3600,
+        help="Simulated time, in seconds.")
+    _('--join-time', type=int, default=600,
+        help="Nodes start at a random time in this interval.")
+    _('--client-count', type=int, default=10)
+    _('--max-clients', type=int,
+        help="(default: client-count * 2)")
+    _('--tunnel-refresh', type=int, default=300)
+    _('--hello', type=int, default=15)
+    _('--strategy', default='random',
+        choices=sorted(tunnel.tunnel_strategy_dict))
+    _('--max-latency', type=float, default=.1,
+        help="One-way latency, in seconds, between opposite corners.")
+    _('--dead-address', type=float, default=.2,
+        help="Fraction of nodes whose first address is dead.")
+    _('--report', type=int, default=60,
+        help="Interval between 2 lines of statistics.")
+    _('--samples', type=int, default=200,
+        help="Number of pairs of nodes to compute the path stretch.")
+    _('--seed', type=int)
+    _('-v', '--verbose', type=int, default=1)
+    config = parser.parse_args()
+
+    utils.setupLog(config.verbose)
+    random.seed(config.seed)
+    sim = Simulator(config)
+    tunnel.Connection = Connection
+    tunnel.time = sim.clock
+
+    sim.addNode(0)
+    for i in xrange(1, config.nodes):
+        sim.call_at(sim.clock.start + random.uniform(0, config.join_time),
+                    lambda i=i: sim.addNode(i))
+
+    print '  time  nodes  reach  tunnels  stretch  created  removed'
+    last = 0, 0
+    for t in xrange(config.report, config.duration + 1, config.report):
+        sim.run(t)
+        last = sim.report(last)
+    print
+    if sim.connected_since is None:
+        print 'Not converged'
+    else:
+        print 'Connected since: %us' % sim.connected_since
+    print 'Tunnel churn: %.2f created per node and per hour' % (
+        3600. * sim.created / config.nodes / config.duration)
+    print 'Parallel attempts: %u (%u successful)' % (
+        sim.races, sim.races_won)
+
+if __name__ == '__main__':
+    main()